@@ -1,8 +1,81 @@
 # -*- coding: utf-8 -*-
 #!/usr/bin/env python
 
-from itertools import product
 from fopy.misc.misc import indent
+from fopy.first_order._relops import CHUNK_CELLS, Relation, Operation, _MixedRadix, _ProductOperation, _ProductRelation
+from fopy.first_order._relops import _OperationView, _RelationView, _subuniverse, _with_undefined
+from fopy.first_order.morphisms import Homomorphism, LazyHomomorphism
+
+import numpy as np
+
+
+def semi_naive_closure(operations, generators):
+    """
+    Clausura de generators (indices) bajo operations, de las que solo se usa
+    arity y vcall. En cada ronda solo se evaluan las tuplas de argumentos con
+    algun elemento de la frontera (lo que aparecio en la ronda anterior):
+    si la primera coordenada en la frontera es la p, las anteriores son
+    viejas y las siguientes cualquier elemento ya generado.
+    Devuelve el array ordenado de indices y una lista con las estadisticas
+    de cada ronda (frontera, tuplas evaluadas y elementos nuevos)
+
+    Con una operacion parcial s, una m definida solo en los impares y la
+    constante c, da lo mismo que cerrar ingenuamente:
+
+    >>> from itertools import combinations, product
+    >>> s, m, c = Operation("s", 1), Operation("m", 2), Operation("c", 0)
+    >>> for a in range(6):
+    ...     s.add((a, a + 2))
+    >>> for a, b in product(range(1, 8, 2), repeat=2):
+    ...     m.add((a, b, a * b % 8))
+    >>> c.add((7,))
+    >>> M = Model(list(range(8)), {}, {"s": s, "m": m, "c": c})
+    >>> ops = list(M.operations.values())
+    >>> elements, stats = semi_naive_closure(ops, [])
+    >>> elements.tolist(), [r["new"] for r in stats]
+    ([1, 3, 5, 7], [1, 1, 1, 0])
+    >>> def naive(generators):
+    ...     result = set(generators)
+    ...     while True:
+    ...         new = {op.icall(*t) for op in ops for t in product(sorted(result), repeat=op.arity)}
+    ...         new.discard(-1)
+    ...         if new <= result:
+    ...             return sorted(result)
+    ...         result |= new
+    >>> all(semi_naive_closure(ops, list(g))[0].tolist() == naive(g)
+    ...     for k in range(3) for g in combinations(range(8), k))
+    True
+    """
+    empty = np.zeros(0, dtype=np.intp)
+    old = empty
+    frontier = [np.asarray(generators, dtype=np.intp).ravel()]
+    frontier += [np.asarray(op.vcall(), dtype=np.intp).ravel() for op in operations if op.arity == 0]
+    frontier = np.unique(np.concatenate(frontier))
+    frontier = frontier[frontier >= 0]
+    stats = []
+    while len(frontier):
+        universe = np.union1d(old, frontier)
+        results = [empty]
+        evaluated = 0
+        for op in operations:
+            for p in range(op.arity):
+                others = len(old) ** p * len(universe) ** (op.arity - p - 1)
+                if not others:
+                    continue
+                step = max(1, CHUNK_CELLS // others)
+                for i in range(0, len(frontier), step):
+                    args = [old] * p + [frontier[i:i + step]] + [universe] * (op.arity - p - 1)
+                    values = op.vcall(*np.ix_(*args))
+                    evaluated += values.size
+                    results.append(np.unique(values))
+        new = np.setdiff1d(np.concatenate(results), universe)
+        new = new[new >= 0]
+        stats.append({"round": len(stats),
+                      "frontier": len(frontier),
+                      "evaluated": evaluated,
+                      "new": len(new)})
+        old, frontier = universe, new
+    return old, stats
 
 
 class Model(object):
@@ -10,10 +83,38 @@ class Model(object):
         """
         Model
         Input: a universe list, relations dict, operations dict
+
+        El universo se interna como 0..n-1 (en el orden de self.universe),
+        cada operacion pasa a ser una tabla densa sobre esos indices y las
+        relaciones se internan sobre los mismos indices. Las operaciones y
+        relaciones internadas en otro universo se copian, asi se pueden
+        compartir
+
+        >>> s = Operation("s", 1)
+        >>> for a in range(3):
+        ...     s.add((a, (a + 1) % 3))
+        >>> A = Model([0, 1, 2], {}, {"s": s})
+        >>> B = Model([-1, 0, 1, 2], {}, {"s": s})
+        >>> A.closure([0])[0], B.closure([0])[0], B.closure([-1])[0]
+        ([0, 1, 2], [0, 1, 2], [-1])
+        >>> R = Relation("R", 1, {(-1,), (0,)})
+        >>> C = Model([-1, 0], {"R": R, "P": Relation("P", 0)}, {})
+        >>> D = Model([0, 1], {"R": R}, {})
+        >>> sorted(C.relations["R"]), list(D.relations["R"]), C.relations["P"]()
+        ([(-1,), (0,)], [(0,)], False)
         """
         self.universe = sorted(universe)
-        self.relations = relations
-        self.operations = operations
+        self.index = {e: i for i, e in enumerate(self.universe)}
+        self.relations = {sym: rel.interned(self.universe, self.index)
+                          for sym, rel in relations.items()}
+        self.operations = {sym: op.interned(self.universe, self.index)
+                           for sym, op in operations.items()}
+
+    def view(self, subuniverse):
+        """
+        Submodelo sobre subuniverse como vista, sin copiar tablas
+        """
+        return SubmodelView(self, subuniverse)
 
     def restrict(self, subuniverse):
         """
@@ -27,23 +128,17 @@ class Model(object):
             operations[o] = self.operations[o].restrict(subuniverse)
         return Model(subuniverse, relations, operations)
 
+    def closure(self, generators):
+        """
+        Subuniverso generado por generators (incluye las constantes)
+        junto con las estadisticas de cada ronda de semi_naive_closure
+        """
+        elements, stats = semi_naive_closure(list(self.operations.values()),
+                                             [self.index[g] for g in generators])
+        return [self.universe[i] for i in elements], stats
+
     def substructure(self, generators):
-        news = set(generators)
-        universe = set()
-
-        while news:
-            local_news = set()
-            for operation in self.operations:
-                arity = self.operations[operation].arity
-                for t in product(universe | news, repeat=arity):
-                    if any(e in news for e in t):  # tiene alguno nuevo
-                        local_news.add(self.operations[operation](*t))
-
-            local_news -= universe
-            local_news -= news
-            universe |= news
-            news = local_news
-        return self.restrict(universe)
+        return self.restrict(self.closure(generators)[0])
 
     def __repr__(self):
         result = "Model(universe=%s,\nrelations=\n" % self.universe
@@ -58,23 +153,54 @@ class Model(object):
     def __len__(self):
         return len(self.universe)
 
-class Submodel(Model):
+class SubmodelView(Model):
 
     """
-    Submodelos de algun tipo de primer orden.
+    Submodelo como vista de un modelo: guarda el array ordenado sub con los
+    indices de sus elementos en el padre y traduce las consultas a las
+    operaciones y relaciones del padre, sin copiar tablas (ver
+    materialize). Lo que una operacion manda fuera del subconjunto queda
+    indefinido
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> V = M.view([0, 2])
+    >>> V.operations["+"](2, 2), V.operations["+"].vcall(np.array([0, 1]), 1).tolist()
+    (0, [1, 0])
+    >>> V.materialize().operations["+"].table.tolist()
+    [[0, 1], [1, 0]]
+    >>> V.operations["+"].vcall(np.array([-1, 1]), 0).tolist()
+    [-1, 1]
+    >>> N = Model(list(range(4)), {"R": Relation("R", 2, {(0, 2), (2, 2), (1, 3)})}, {})
+    >>> R = N.view([0, 2]).relations["R"]
+    >>> sorted(R), len(R), R.vcall(np.array([-1, 1]), 1).tolist()
+    ([(0, 2), (2, 2)], 2, [False, True])
+    >>> from fopy.first_order.congruences import Cg, Partition, compatibility_witness
+    >>> W = M.view(M.universe)
+    >>> Cg(W, [(0, 2)]), compatibility_witness(W, Partition([(0, 2), (1, 3)], W.universe))
+    (Congruence([|0, 2|, |1, 3|]), None)
     """
 
-    def __init__(self, fo_type, universe, operations, relations, supermodel):
-        super(FO_Submodel, self).__init__(
-            fo_type, universe, operations, relations)
+    def __init__(self, supermodel, subuniverse):
         self.supermodel = supermodel
+        self.sub = _subuniverse(supermodel.index, subuniverse)
+        self.universe = [supermodel.universe[i] for i in self.sub]
+        self.index = {e: i for i, e in enumerate(self.universe)}
+        padded = _with_undefined(self.sub)
+        self.operations = {sym: _OperationView(op, self.sub, padded, self.universe, self.index)
+                           for sym, op in supermodel.operations.items()}
+        self.relations = {sym: _RelationView(rel, self.sub, padded, self.universe, self.index)
+                          for sym, rel in supermodel.relations.items()}
+
+    def materialize(self):
+        """
+        Copia compacta del submodelo como Model
+        """
+        return self.supermodel.restrict(self.universe)
 
     def __repr__(self):
-        result = "FO_Submodel(\n"
-        result += indent(repr(self.fo_type) + ",\n")
+        result = "SubmodelView(\n"
         result += indent(repr(self.universe) + ",\n")
-        result += indent(repr(self.operations) + ",\n")
-        result += indent(repr(self.relations) + ",\n")
         result += indent("supermodel= " + repr(self.supermodel) + "\n")
         return result + ")"
 
@@ -82,98 +208,171 @@ class Submodel(Model):
         """
         Genera el Embedding natural entre el submodelo y el modelo
         """
-        d = {(x,): x for x in self.universe}
-        return Embedding(d, self, self.supermodel, self.fo_type)
+        return Homomorphism(self.sub, self, self.supermodel)
 
     def is_subdirect(self):
         """
         Dado un submodelo de un producto, decide si es un producto subdirecto o no
         """
-        if isinstance(self.supermodel, FO_Product):
+        if isinstance(self.supermodel, Product):
             for i in self.supermodel.indices():
-                if not set((self.supermodel.projection(i).composition(self.natural_embedding())).image_model().universe) == set(self.supermodel.factors[i].universe):
+                image = np.unique(self.supermodel.project(i, self.sub))
+                if len(image) != len(self.supermodel.factors[i]):
                     return False
             return True
         return False
 
 
+Submodel = SubmodelView
+
+
+class _RangeIndex(object):
+    """
+    Indice de range(n) (cada elemento es su propio indice) sin armar el
+    diccionario
+    """
+
+    def __init__(self, n):
+        self.n = n
+
+    def __getitem__(self, e):
+        if isinstance(e, (int, np.integer)) and 0 <= e < self.n:
+            return int(e)
+        raise KeyError(e)
+
+    def __contains__(self, e):
+        return isinstance(e, (int, np.integer)) and 0 <= e < self.n
+
+    def get(self, e, default=None):
+        return int(e) if e in self else default
+
+    def __iter__(self):
+        return iter(range(self.n))
+
+    def __len__(self):
+        return self.n
+
+
 class Product(Model):
 
+    """
+    Producto directo perezoso: los elementos son los enteros 0..N-1 que
+    codifican en base mixta las tuplas de indices de los factores (la
+    primera coordenada es la mas significativa) y nunca se arma el
+    universo. Las operaciones y relaciones se evaluan coordenada a
+    coordenada sobre las de los factores, vectorizadas sobre arrays de
+    elementos
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> Z2 = cyclic_group(2)
+    >>> P = Product([Z2, Z2, Z2])
+    >>> len(P), P.decode(P.operations["+"](P.encode((1, 0, 1)), P.encode((1, 1, 0))))
+    (8, (0, 1, 1))
+    >>> sorted(P.closure([P.encode((1, 1, 0)), P.encode((0, 1, 1))])[0])
+    [0, 3, 5, 6]
+    >>> pi = P.projection(2)
+    >>> pi(P.encode((0, 1, 1))), pi(np.array([1, 2, -1])).tolist()
+    (1, [1, 0, -1])
+    """
+
     def __init__(self, factors):
         """
-        Toma una lista de factores
+        Toma una lista de factores (los que son productos se aplanan)
         """
-        # TODO falta un armar las operaciones y relaciones
+        flat = []
         for f in factors:
-            if isinstance(f,FO_Product):
-                factors.remove(f)
-                factors+=f.factors
-        self.factors = factors
-
-        fo_type = factors[0].fo_type
-        if any(f.fo_type != fo_type for f in factors):
-            raise ValueError("Factors must be all from same fo_type")
-
-        d_universe = list(product(*[f.universe for f in factors]))
-
-        operations = {}
-        for op in fo_type.operations:
-            if fo_type.operations[op] == 0:
-                operations[op] = FO_Constant(tuple([f.operations[op]() for f in factors]))
+            if isinstance(f, Product):
+                flat += f.factors
             else:
-                operations[op] = FO_Operation_Product([f.operations[op] for f in factors],[f.universe for f in factors])
+                flat.append(f)
+        self.factors = flat
+
+        def signature(m):
+            return ({sym: op.arity for sym, op in m.operations.items()},
+                    {sym: rel.arity for sym, rel in m.relations.items()})
+        if any(signature(f) != signature(flat[0]) for f in flat):
+            raise ValueError("Factors must be all from same type")
+
+        self.radix = _MixedRadix([len(f) for f in flat])
+        self.universe = range(self.radix.total)
+        self.index = _RangeIndex(self.radix.total)
+        self.operations = {}
+        for sym, op in flat[0].operations.items():
+            self.operations[sym] = _ProductOperation(sym, op.arity, [f.operations[sym] for f in flat],
+                                                     self.radix, self.universe, self.index)
+        self.relations = {}
+        for sym, rel in flat[0].relations.items():
+            self.relations[sym] = _ProductRelation(sym, rel.arity, [f.relations[sym] for f in flat],
+                                                   self.radix, self.universe, self.index)
+
+    def encode(self, t):
+        """
+        Elemento del producto que corresponde a la tupla t de elementos de
+        los factores
+        """
+        return int(self.radix.encode([f.index[a] for f, a in zip(self.factors, t)]))
 
-        relations = {}
-        for rel in fo_type.relations:
-            relations[rel] = FO_Relation_Product([f.relations[rel] for f in factors],[f.universe for f in factors])
+    def decode(self, x):
+        """
+        Tupla de elementos de los factores que corresponde a x
+        """
+        return tuple(f.universe[d] for f, d in zip(self.factors, self.radix.decode(x)))
 
-        super(FO_Product, self).__init__(fo_type,
-                                         d_universe,
-                                         operations,
-                                         relations)
+    def project(self, i, xs):
+        """
+        Indices en el factor i de la coordenada i de un array de elementos
+        """
+        return self.radix.digit(xs, i)
 
     def projection(self, i):
         """
-        Genera el morfismo que es la proyección en la coordenada i
+        Genera el morfismo que es la proyección en la coordenada i, que
+        calcula las coordenadas recien cuando se lo aplica
         """
         assert i in self.indices()
-        d = {(x,): x[i] for x in self.universe}
-        return Homomorphism(d, self, self.factors[i], self.fo_type, surj=True)
+        return LazyHomomorphism(lambda xs: self.project(i, xs), self, self.factors[i])
 
     def indices(self):
         return list(range(len(self.factors)))
 
+    def __repr__(self):
+        result = "Product(\n"
+        for f in self.factors:
+            result += indent(repr(f) + ",")
+        return result + ")"
+
 
-class FO_SubdirectProduct(Submodel):
+class FO_SubdirectProduct(SubmodelView):
 
     """
     Producto Subdirecto
 
-    >>> from definability.examples.examples import *
-    >>> M2=Model(tiporetacotado, [0,1], {'^': FO_Operation({(0,0):0,(0,1): 0,(1,0): 0,(1,1): 1}),'v': FO_Operation({(0,0):0,(0,1): 1,(1,0): 1,(1,1): 1}),'Max': FO_Constant(1),'Min': FO_Constant(0)}, {})
-    >>> P=M2*M2*M2
-    >>> FO_SubdirectProduct([(1,1,1), (0,0,0), (0,1,1)], P).is_global()
+    >>> ops = {"^": Operation("^", 2), "v": Operation("v", 2), "Max": Operation("Max", 0), "Min": Operation("Min", 0)}
+    >>> for a in range(2):
+    ...     for b in range(2):
+    ...         ops["^"].add((a, b, min(a, b)))
+    ...         ops["v"].add((a, b, max(a, b)))
+    >>> ops["Max"].add((1,))
+    >>> ops["Min"].add((0,))
+    >>> M2 = Model([0, 1], {}, ops)
+    >>> P = Product([M2, M2, M2])
+    >>> FO_SubdirectProduct([P.encode(t) for t in [(1,1,1), (0,0,0), (0,1,1)]], P).is_global()
     False
-    >>> FO_SubdirectProduct([(1,1,1), (0,0,0), (0,1,1), (1,0,0)], P).is_global()
+    >>> FO_SubdirectProduct([P.encode(t) for t in [(1,1,1), (0,0,0), (0,1,1), (1,0,0)]], P).is_global()
     True
+    >>> S = FO_SubdirectProduct([P.encode(t) for t in [(1,1,1), (0,0,0), (0,1,1)]], P)
+    >>> S.tita(0), [S.tita(i).preserva_operaciones() for i in P.indices()]
+    (Congruence([|0, 3|, |7|]), [True, True, True])
     """
 
     def __init__(self, universe, supermodel):
-        assert isinstance(supermodel, FO_Product)
-        super(FO_SubdirectProduct, self).__init__(
-                supermodel.fo_type,
-                universe,
-                {op: supermodel.operations[op].restrict(universe) for op in supermodel.operations},
-                {rel: supermodel.relations[rel].restrict(universe) for rel in supermodel.relations},
-                supermodel)
+        assert isinstance(supermodel, Product)
+        super(FO_SubdirectProduct, self).__init__(supermodel, universe)
         assert self.is_subdirect()
 
     def __repr__(self):
         result = "FO_SubdirectProduct(\n"
-        result += indent(repr(self.fo_type) + ",\n")
         result += indent(repr(self.universe) + ",\n")
-        result += indent(repr(self.operations) + ",\n")
-        result += indent(repr(self.relations) + ",\n")
         result += indent("Product= " + repr(self.supermodel) + "\n")
         return result + ")"
 
@@ -181,8 +380,11 @@ class FO_SubdirectProduct(Submodel):
         """
         Congruencia de la forma tita(i) = {(x,y) in A^2 : x(i) = y(i)}
         """
+        from fopy.first_order.congruences import Congruence
         assert i in self.supermodel.indices()
-        return (self.supermodel.projection(i).composition(self.natural_embedding())).kernel()
+        result = Congruence((), self)
+        result.from_ids(self.supermodel.project(i, self.sub))
+        return result
 
     def sigma(self):
         """
@@ -197,77 +399,62 @@ class FO_SubdirectProduct(Submodel):
         """
         Determina si el producto subdirecto es global o no
         """
-        sigma = self.sigma()
-        sigma_m = minorice(sigma)
-        n = len(sigma_m)
-        for xs in list(product(*[self.universe for i in list(range(n))])):
-            if is_system(sigma_m, xs, lambda x, y: sup_proj(sigma, x, y)):
-                CS = CongruenceSystem(sigma_m, list(xs), sigma)
-                if not CS.has_solution():
-                    return False
-        return True
+        from fopy.first_order.congruences import unsolvable_system
+        return unsolvable_system(self.sigma()) is None
 
 
 class FO_Quotient(Model):
 
     """
     Modelo Cociente
-    Dado un algebra y una congruencia, devuelve el álgebra cociente
+    Dado un modelo y una congruencia, devuelve el modelo cociente.
+    Cada bloque se representa por su primer elemento; las tablas salen de
+    evaluar (vcall) las operaciones en los representantes y pasar el resultado
+    a id de bloque, y las relaciones son las imagenes
+
+    >>> from fopy.first_order.congruences import Cg
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> Q = FO_Quotient(M, Cg(M, [(0, 2)]))
+    >>> Q.universe, Q.operations["+"].table.tolist()
+    ([0, 1], [[0, 1], [1, 0]])
+    >>> Q.natural_map()(3)
+    1
+    >>> P = Product([cyclic_group(2), cyclic_group(2)])
+    >>> FO_Quotient(P, Cg(P, [(0, 1)])).universe
+    [0, 2]
     """
 
     def __init__(self, supermodel, congruence):
-        assert supermodel.fo_type.relations == {}
-        uni = list(supermodel.universe)
-        elim = []
-        n = len(uni)
-        for i in range(n):
-            if uni[i] not in elim:
-                for j in range(i + 1, n):
-                    if [uni[i], uni[j]] in congruence:
-                        elim.append(uni[j])
-        for i in elim:
-            uni.remove(i)
+        self.ids = congruence.block_ids()
+        reps = congruence.representatives()
+        uni = [supermodel.universe[i] for i in reps]
+        index = {e: i for i, e in enumerate(uni)}
+        blocks = _with_undefined(self.ids)
         operations = {}
-        for op in supermodel.operations:
-            ope = supermodel.operations[op].restrict(uni)
-            d = {}
-            if supermodel.operations[op].arity() != 0:
-                for i in list(ope.domain()):
-                    if not ope(*i) in uni:
-                        for j in uni:
-                            if [ope(*i), j] in congruence:
-                                d[i] = j
-                                break
-                    else:
-                        d[i] = ope(*i)
-                operations[op] = FO_Operation(d, uni, ope.arity())
-            else:
-                if not ope() in uni:
-                    for j in uni:
-                        if [ope(), j] in congruence:
-                            operations[op] = FO_Constant(j)
-                else:
-                    operations[op] = ope
-        super(FO_Quotient, self).__init__(
-            supermodel.fo_type, uni, operations, {})
+        for sym, op in supermodel.operations.items():
+            operations[sym] = Operation(op.sym, op.arity)
+            operations[sym]._set_table(np.asarray(blocks[op.vcall(*np.ix_(*[reps] * op.arity))]),
+                                       uni, index)
+        relations = {}
+        for sym, rel in supermodel.relations.items():
+            idx = rel.index_array()
+            image = np.unique(self.ids[idx], axis=0) if len(idx) else idx
+            relations[sym] = Relation(rel.sym, rel.arity,
+                                      {tuple(uni[b] for b in t) for t in image.tolist()})
+        super(FO_Quotient, self).__init__(uni, relations, operations)
         self.congruence = congruence
         self.supermodel = supermodel
 
     def natural_map(self):
         """
-        Devuelve el mapa natural entre el álgebra y el cociente
+        Devuelve el mapa natural entre el modelo y el cociente, que es el
+        vector de ids de bloque
         """
-        d = {}
-        for i in self.supermodel.universe:
-            for j in self.universe:
-                if [i, j] in self.congruence:
-                    d[(i,)] = j
-                    break
-        return Homomorphism(d, self.supermodel, self, self.fo_type, surj=True)
+        return Homomorphism(self.ids, self.supermodel, self)
 
     def __repr__(self):
         result = "FO_Quotient(\n"
-        result += indent(repr(self.fo_type) + ",\n")
         result += indent(repr(self.universe) + ",\n")
         result += indent(repr(self.operations) + ",\n")
         result += indent(repr(self.relations) + ",\n")
@@ -1,82 +1,897 @@
 # -*- coding: utf-8 -*-
 # !/usr/bin/env python
 # TODO decoradores para hacer operaciones y relaciones procedurales
+from itertools import product
+from functools import reduce
+
+import numpy as np
+
+
+DENSE_MAX_CELLS = 2 ** 24
+DENSE_SMALL_CELLS = 2 ** 16
+# desde esta densidad el tensor (1 byte por celda) ocupa menos que los int64
+DENSE_MIN_DENSITY = 1 / 8
+SPARSE_MAX_CELLS = 2 ** 63
+# celdas por bloque en los calculos vectorizados que se hacen por partes
+CHUNK_CELLS = 2 ** 22
+
+
+def density(ntuples, size, arity):
+    """
+    Proporcion de tuplas de universe^arity que estan en la relacion
+    """
+    return float(ntuples) / (size ** arity)
+
+
+def choose_storage(size, arity, ntuples):
+    """
+    Elige como guardar una relacion de ntuples tuplas de aridad arity sobre
+    un universo de tamaño size: "dense", "sparse" o "set"
+
+    >>> choose_storage(10, 2, 5), choose_storage(200, 3, 10), choose_storage(200, 3, 2 * 10 ** 6)
+    ('dense', 'sparse', 'dense')
+    >>> choose_storage(10 ** 7, 3, 10)
+    'set'
+    """
+    cells = size ** arity
+    if cells <= DENSE_SMALL_CELLS:
+        return "dense"
+    if cells <= DENSE_MAX_CELLS and density(ntuples, size, arity) >= DENSE_MIN_DENSITY:
+        return "dense"
+    if cells <= SPARSE_MAX_CELLS:
+        return "sparse"
+    return "set"
+
+
+def _subuniverse(index, subuniverse):
+    """
+    Array ordenado con los indices de los elementos de subuniverse
+    """
+    return np.array(sorted({index[e] for e in subuniverse if e in index}), dtype=np.intp)
+
+
+def _with_undefined(array):
+    """
+    Copia del array de indices con un lugar de mas al final en -1, para
+    indexarlo con arrays que usan -1 como indefinido: el -1 cae en -1
+    """
+    return np.append(np.asarray(array, dtype=np.intp), -1)
+
+
+def _index_rows(tuples, index, arity):
+    """
+    Array (len, arity) con los indices de las tuplas que caen en index
+    """
+    idx = [tuple(index[a] for a in t) for t in tuples if all(a in index for a in t)]
+    return np.array(idx, dtype=np.intp).reshape(len(idx), arity)
+
+
+def _inverse_with_undefined(sub, n):
+    """
+    Inverso de sub (indices distintos de 0..n-1) como array de n + 1
+    lugares: manda sub[i] en i y lo demas (incluido el -1) en -1
+    """
+    inverse = np.full(n + 1, -1, dtype=np.intp)
+    inverse[sub] = np.arange(len(sub))
+    return inverse
+
+
+class _DenseRelation(object):
+    """
+    Relacion guardada como tensor booleano de forma (n,)*arity
+    """
+    
+    def __init__(self, table):
+        # con aridad 0 los operadores de numpy devuelven escalares
+        self.table = np.asarray(table)
+    
+    def contains(self, t):
+        return self.table.item(t)
+    
+    def vcontains(self, arrays):
+        return self.table[arrays]
+    
+    def add(self, t):
+        self.table[t] = True
+    
+    def __len__(self):
+        return int(np.count_nonzero(self.table))
+    
+    def indices(self):
+        """
+        Array (len, arity) con las tuplas de indices de la relacion
+        """
+        return np.argwhere(self.table)
+    
+    def restrict(self, sub):
+        return _DenseRelation(np.asarray(self.table[np.ix_(*[sub] * self.table.ndim)]))
+    
+    def _grid(self):
+        return np.ix_(*[np.arange(n) for n in self.table.shape])
+    
+    def union(self, other):
+        if isinstance(other, _DenseRelation):
+            return _DenseRelation(self.table | other.table)
+        return _DenseRelation(self.table | other.vcontains(self._grid()))
+    
+    def intersection(self, other):
+        if isinstance(other, _DenseRelation):
+            return _DenseRelation(self.table & other.table)
+        if other.negated:
+            return _DenseRelation(self.table & other.vcontains(self._grid()))
+        return other.intersection(self)
+    
+    def complement(self):
+        return _DenseRelation(~self.table)
+
+
+class _SparseRelation(object):
+    """
+    Relacion guardada como array ordenado de int64, cada tupla codificada
+    en base n (el primer elemento es el digito mas significativo).
+    Si negated es True la relacion es el complemento de codes, asi el
+    complemento de una relacion rala no recorre universe^arity
+    """
+    
+    def __init__(self, codes, size, arity, negated=False):
+        self.codes = codes
+        self.size = size
+        self.arity = arity
+        self.negated = negated
+        self.weights = [size ** i for i in range(arity - 1, -1, -1)]
+        self.aweights = np.array(self.weights, dtype=np.int64)
+        self.pending = []
+    
+    def _flush(self):
+        """
+        Mezcla las tuplas agregadas con add en el array ordenado
+        """
+        if self.pending:
+            pending = np.array(self.pending, dtype=np.int64)
+            if self.negated:
+                self.codes = np.setdiff1d(self.codes, pending)
+            else:
+                self.codes = np.union1d(self.codes, pending)
+            self.pending = []
+    
+    def encode(self, arrays):
+        """
+        Codifica arrays de indices (con broadcasting)
+        """
+        code = np.zeros((), dtype=np.int64)
+        for a, w in zip(arrays, self.aweights):
+            code = code + np.asarray(a, dtype=np.int64) * w
+        return code
+    
+    def encode_rows(self, idx):
+        """
+        Codifica un array (m, arity) de tuplas de indices
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        return idx.reshape(len(idx), self.arity) @ self.aweights
+    
+    def decode(self, codes):
+        """
+        Array (m, arity) con las tuplas de indices de codes
+        """
+        return (codes[:, None] // self.aweights) % self.size
+    
+    def from_indices(self, idx):
+        self.codes = np.unique(self.encode_rows(idx))
+        return self
+    
+    def contains(self, t):
+        self._flush()
+        code = sum(i * w for i, w in zip(t, self.weights))
+        pos = self.codes.searchsorted(code)
+        return bool(pos < len(self.codes) and self.codes[pos] == code) != self.negated
+    
+    def vcontains(self, arrays):
+        self._flush()
+        code = self.encode(arrays)
+        if not len(self.codes):
+            return np.full(code.shape, self.negated, dtype=np.bool_)
+        pos = np.minimum(self.codes.searchsorted(code), len(self.codes) - 1)
+        return (self.codes[pos] == code) != self.negated
+    
+    def add(self, t):
+        self.pending.append(sum(i * w for i, w in zip(t, self.weights)))
+    
+    def __len__(self):
+        self._flush()
+        if self.negated:
+            return self.size ** self.arity - len(self.codes)
+        return len(self.codes)
+    
+    def indices(self):
+        """
+        Array (len, arity) con las tuplas de indices de la relacion
+        """
+        self._flush()
+        if self.negated:
+            # hay que listar el complemento, que es lo que se pide
+            return self.decode(np.setdiff1d(np.arange(self.size ** self.arity, dtype=np.int64),
+                                            self.codes, assume_unique=True))
+        return self.decode(self.codes)
+    
+    def restrict(self, sub):
+        self._flush()
+        idx = _inverse_with_undefined(sub, self.size)[self.decode(self.codes)]
+        # sub esta ordenado, asi que los codigos nuevos siguen ordenados
+        # y el complemento de lo que queda es el complemento restringido
+        result = _SparseRelation(None, len(sub), self.arity, self.negated)
+        result.codes = result.encode_rows(idx[(idx >= 0).all(axis=1)])
+        return result
+    
+    def union(self, other):
+        if not isinstance(other, _SparseRelation):
+            return other.union(self)
+        self._flush()
+        other._flush()
+        # De Morgan sobre los codigos guardados
+        if not self.negated and not other.negated:
+            codes, negated = np.union1d(self.codes, other.codes), False
+        elif not self.negated:
+            codes, negated = np.setdiff1d(other.codes, self.codes, assume_unique=True), True
+        elif not other.negated:
+            codes, negated = np.setdiff1d(self.codes, other.codes, assume_unique=True), True
+        else:
+            codes, negated = np.intersect1d(self.codes, other.codes, assume_unique=True), True
+        return _SparseRelation(codes, self.size, self.arity, negated)
+    
+    def intersection(self, other):
+        self._flush()
+        if not isinstance(other, _SparseRelation):
+            if self.negated:
+                return other.intersection(self)
+            inside = np.broadcast_to(other.vcontains(tuple(self.indices().T)), self.codes.shape)
+            return _SparseRelation(self.codes[inside], self.size, self.arity)
+        other._flush()
+        if not self.negated and not other.negated:
+            codes, negated = np.intersect1d(self.codes, other.codes, assume_unique=True), False
+        elif not self.negated:
+            codes, negated = np.setdiff1d(self.codes, other.codes, assume_unique=True), False
+        elif not other.negated:
+            codes, negated = np.setdiff1d(other.codes, self.codes, assume_unique=True), False
+        else:
+            codes, negated = np.union1d(self.codes, other.codes), True
+        return _SparseRelation(codes, self.size, self.arity, negated)
+    
+    def complement(self):
+        self._flush()
+        return _SparseRelation(self.codes, self.size, self.arity, not self.negated)
+
+
 class Relation(object):
     """
     Relation
+
+    Mientras se carga es un set de tuplas; al entrar en un Model se interna
+    sobre los indices 0..n-1 del universo y, segun su densidad (ver
+    choose_storage), se guarda como tensor booleano denso de forma
+    (n,)*arity o como array ordenado de tuplas codificadas en int64
+
+    Las operaciones de conjuntos dan lo mismo con cualquier combinacion de
+    guardados:
+
+    >>> universe = [0, 1, 2]
+    >>> index = {e: i for i, e in enumerate(universe)}
+    >>> A, B = {(0, 1), (1, 1), (2, 0)}, {(1, 1), (2, 2)}
+    >>> full = set(product(universe, repeat=2))
+    >>> ok = []
+    >>> for s1, s2 in product(["dense", "sparse", "set"], repeat=2):
+    ...     R, S = Relation("R", 2, set(A)), Relation("S", 2, set(B))
+    ...     R.intern(universe, index, s1)
+    ...     S.intern(universe, index, s2)
+    ...     ok.append(set(R.union(S)) == A | B and
+    ...               set(R.intersection(S)) == A & B and
+    ...               set(R.complement()) == full - A and
+    ...               set(R.complement().union(S)) == (full - A) | B and
+    ...               set(S.intersection(R.complement())) == B - A and
+    ...               set(R.complement().intersection(S.complement())) == full - (A | B))
+    >>> all(ok)
+    True
+
+    El complemento de una relacion rala se guarda como negacion:
+
+    >>> R = Relation("R", 2, set(A))
+    >>> R.intern(universe, index, "sparse")
+    >>> C = R.complement()
+    >>> C.storage.negated, len(C), C(0, 1), C(0, 0)
+    (True, 6, False, True)
+    >>> C.add((0, 1))
+    >>> len(C), C(0, 1)
+    (7, True)
     """
     
-    def __init__(self, sym, arity, rel=set(), formula=None):
+    def __init__(self, sym, arity, rel=None, formula=None):
         self.sym = sym
         self.arity = arity
-        self.r = rel
+        self.r = set() if rel is None else rel
         self.formula = formula
+        self.storage = None
+        self.universe = None
+        self.index = None
+    
+    def intern(self, universe, index, storage=None):
+        """
+        Interna la relacion sobre universe.
+        storage puede ser "dense", "sparse" o "set"; por defecto se elige
+        con choose_storage. Con cualquiera se descartan las tuplas que se
+        salen del universo
+
+        >>> for storage in ["dense", "sparse", "set"]:
+        ...     R = Relation("R", 1, {(0,), (5,)})
+        ...     R.intern([0, 1], {0: 0, 1: 1}, storage)
+        ...     print(storage, sorted(R), len(R))
+        dense [(0,)] 1
+        sparse [(0,)] 1
+        set [(0,)] 1
+        """
+        if self.universe is not None and self.universe != universe:
+            raise ValueError('%s is already interned in another universe' % self.sym)
+        if storage is None:
+            if self.universe is not None:
+                return
+            storage = choose_storage(len(universe), self.arity, len(self))
+        tuples = list(self)
+        self.universe = universe
+        self.index = index
+        if storage in ("dense", "sparse"):
+            idx = _index_rows(tuples, index, self.arity)
+            if storage == "dense":
+                table = np.zeros((len(universe),) * self.arity, dtype=np.bool_)
+                if len(idx):
+                    table[tuple(idx.T)] = True
+                self.storage = _DenseRelation(table)
+            else:
+                self.storage = _SparseRelation(None, len(universe), self.arity).from_indices(idx)
+            self.r = None
+        elif storage == "set":
+            self.storage = None
+            self.r = {t for t in tuples if all(a in index for a in t)}
+        else:
+            raise ValueError("Unknown storage %s" % storage)
+    
+    def interned(self, universe, index):
+        """
+        La relacion internada sobre universe sin tocar self: self misma si
+        ya lo esta y si no una copia (sin las tuplas que se salen)
+        """
+        if self.universe is not None and self.universe == universe:
+            return self
+        result = Relation(self.sym, self.arity, set(self), self.formula)
+        result.intern(universe, index)
+        return result
+    
+    def index_array(self):
+        """
+        Array (len, arity) con las tuplas de indices de la relacion,
+        necesita la relacion internada
+
+        >>> R = Relation("R", 2, {(0, 2)})
+        >>> R.intern([0, 1, 2], {0: 0, 1: 1, 2: 2}, "set")
+        >>> R.index_array().tolist()
+        [[0, 2]]
+        """
+        if self.universe is None:
+            raise ValueError('%s is not interned in a universe' % self.sym)
+        if self.storage is None:
+            return _index_rows(self.r, self.index, self.arity)
+        return self.storage.indices()
     
     def add(self, t):
         if len(t) != self.arity:
             raise ValueError('%s is not of arity %s' % (t, self.arity))
-        self.r.add(t)
+        if self.storage is None:
+            self.r.add(t)
+        else:
+            self.storage.add(tuple(self.index[a] for a in t))
     
     def __repr__(self):
-        return "%s : %s" % (self.sym, self.r)
+        return "%s : %s" % (self.sym, set(self))
     
     def __call__(self, *args):
-        return args in self.r
+        if self.storage is None:
+            return args in self.r
+        try:
+            return self.storage.contains(tuple(self.index[a] for a in args))
+        except KeyError:
+            return False
+    
+    def icall(self, *args):
+        """
+        Pertenencia de una tupla de indices del universo
+        """
+        if self.storage is None:
+            return tuple(self.universe[i] for i in args) in self.r
+        return self.storage.contains(args)
+    
+    def vcall(self, *arrays):
+        """
+        Pertenencia de arrays de indices (con broadcasting),
+        devuelve un array booleano
+        """
+        if self.storage is None:
+            return np.vectorize(self.icall, otypes=[np.bool_])(*arrays)
+        return self.storage.vcontains(arrays)
     
     def __len__(self):
-        return len(self.r)
+        if self.storage is None:
+            return len(self.r)
+        return len(self.storage)
     
     def __iter__(self):
-        return iter(self.r)
+        if self.storage is None:
+            return iter(self.r)
+        return (tuple(self.universe[i] for i in t) for t in self.storage.indices())
     
     def restrict(self, subuniverse):
+        if self.storage is None:
+            result = Relation(self.sym, self.arity)
+            subuniverse = set(subuniverse)
+            for t in self.r:
+                if set(t) <= subuniverse:
+                    result.add(t)
+            return result
+        sub = _subuniverse(self.index, subuniverse)
         result = Relation(self.sym, self.arity)
-        subuniverse = set(subuniverse)
-        for t in self.r:
-            if set(t) <= subuniverse:
-                result.add(t)
+        result._set_storage(self.storage.restrict(sub), [self.universe[i] for i in sub])
+        return result
+    
+    def _set_storage(self, storage, universe, index=None):
+        self.storage = storage
+        self.universe = universe
+        self.index = {e: i for i, e in enumerate(universe)} if index is None else index
+        self.r = None
+    
+    def _combine(self, other, symbol, method, fallback):
+        if self.arity != other.arity:
+            raise ValueError('%s and %s have different arities' % (self.sym, other.sym))
+        sym = "(%s %s %s)" % (self.sym, symbol, other.sym)
+        if self.storage is not None and other.storage is not None and self.universe == other.universe:
+            result = Relation(sym, self.arity)
+            result._set_storage(getattr(self.storage, method)(other.storage), self.universe, self.index)
+            return result
+        return Relation(sym, self.arity, fallback(set(self), set(other)))
+    
+    def union(self, other):
+        """
+        Union con otra relacion de la misma aridad
+        """
+        return self._combine(other, "∪", "union", set.union)
+    
+    def intersection(self, other):
+        """
+        Interseccion con otra relacion de la misma aridad
+        """
+        return self._combine(other, "∩", "intersection", set.intersection)
+    
+    def complement(self):
+        """
+        Complemento respecto de universe^arity, necesita la relacion internada
+        """
+        if self.universe is None:
+            raise ValueError('%s is not interned in a universe' % self.sym)
+        sym = "¬%s" % self.sym
+        if self.storage is None:
+            return Relation(sym, self.arity, set(product(self.universe, repeat=self.arity)) - self.r)
+        result = Relation(sym, self.arity)
+        result._set_storage(self.storage.complement(), self.universe, self.index)
         return result
     
     def __hash__(self):
-        return hash(frozenset(self.r))
+        return hash(frozenset(self))
 
 
 class Operation(object):
     """
     Operation
+
+    Mientras se carga guarda el grafico en un diccionario; al entrar en un
+    Model se interna como una tabla de Cayley densa de forma (n,)*arity
+    sobre los indices 0..n-1 del universo. Los elementos originales solo se
+    usan en los bordes (__call__, items, repr).
     """
     
     def __init__(self, sym, arity):
         self.sym = sym
         self.arity = arity
         self.op = dict()
+        self.table = None
+        self.universe = None
+        self.index = None
     
     def add(self, t):
         if len(t) - 1 != self.arity:
             raise ValueError('%s is not of arity %s' % (t[:-1], self.arity))
-        self.op[t[:-1]] = t[-1]
+        if self.table is None:
+            self.op[t[:-1]] = t[-1]
+        else:
+            self.table[tuple(self.index[a] for a in t[:-1])] = self.index[t[-1]]
+    
+    def intern(self, universe, index):
+        """
+        Pasa el grafico a una tabla de indices sobre universe.
+        Los argumentos sin valor (o con valor fuera del universo) quedan en -1
+        """
+        if self.table is not None:
+            if self.universe == universe:
+                return
+            raise ValueError('%s is already interned in another universe' % self.sym)
+        table = np.full((len(universe),) * self.arity, -1, dtype=np.intp)
+        for t, v in self.items():
+            if all(a in index for a in t):
+                table[tuple(index[a] for a in t)] = index.get(v, -1)
+        self._set_table(table, universe, index)
+    
+    def interned(self, universe, index):
+        """
+        La operacion internada sobre universe sin tocar self: self mismo si
+        ya lo esta y si no una copia
+        """
+        if self.table is not None and self.universe == universe:
+            return self
+        result = Operation(self.sym, self.arity)
+        result.op = dict(self.items())
+        result.intern(universe, index)
+        return result
+    
+    def _set_table(self, table, universe, index):
+        self.table = table
+        self.universe = universe
+        self.index = index
+        self.op = None
+    
+    def items(self):
+        """
+        Iterador sobre los pares (argumentos, resultado) del grafico
+        """
+        if self.table is None:
+            return iter(self.op.items())
+        return ((tuple(self.universe[i] for i in t), self.universe[self.table[t]])
+                for t in map(tuple, np.argwhere(self.table >= 0)))
     
     def __repr__(self):
-        return "%s : %s" % (self.sym, self.op)
+        return "%s : %s" % (self.sym, dict(self.items()))
     
     def __call__(self, *args):
-        return self.op[args]
+        if self.table is None:
+            return self.op[args]
+        try:
+            result = self.table.item(tuple(self.index[a] for a in args))
+        except KeyError:
+            raise KeyError(args)
+        if result < 0:
+            raise KeyError(args)
+        return self.universe[result]
+    
+    def icall(self, *args):
+        """
+        Aplica la operacion a indices del universo, devuelve un indice
+        """
+        return self.table.item(args)
+    
+    def dense_table(self):
+        """
+        Tabla de Cayley de forma (n,)*arity (-1 donde no esta definida)
+        """
+        return self.table
+    
+    def vcall(self, *arrays):
+        """
+        Aplica la operacion a arrays de indices (con broadcasting),
+        devuelve el array de indices resultado
+        """
+        return self.table[arrays]
     
     def __len__(self):
-        return len(self.op)
+        if self.table is None:
+            return len(self.op)
+        return int(np.count_nonzero(self.table >= 0))
     
     def restrict(self, subuniverse):
+        if self.table is None:
+            result = Operation(self.sym, self.arity)
+            subuniverse = set(subuniverse)
+            for t in self.op:
+                if set(t) <= subuniverse:
+                    result.add(t + (self.op[t],))
+            return result
+        sub = _subuniverse(self.index, subuniverse)
+        inverse = _inverse_with_undefined(sub, len(self.universe))
+        universe = [self.universe[i] for i in sub]
         result = Operation(self.sym, self.arity)
-        subuniverse = set(subuniverse)
-        for t in self.op:
-            if set(t) <= subuniverse:
-                result.add(t + (self.op[t],))
+        result._set_table(np.asarray(inverse[self.table[np.ix_(*[sub] * self.arity)]]),
+                          universe,
+                          {e: i for i, e in enumerate(universe)})
         return result
     
     def graph_rel(self):
-        rel = {t + (self.op[t],) for t in self.op}
+        rel = {t + (v,) for t, v in self.items()}
         return Relation("g" + self.sym, self.arity + 1, rel)
 
+
+class _MixedRadix(object):
+    """
+    Codifica tuplas de indices (d0, ..., dk-1) con di < sizes[i] como el
+    entero d0 * weights[0] + ... + dk-1 * weights[k-1] (la primera
+    coordenada es la mas significativa)
+    """
+    
+    def __init__(self, sizes):
+        self.sizes = list(sizes)
+        self.weights = []
+        total = 1
+        for size in reversed(self.sizes):
+            self.weights.insert(0, total)
+            total *= size
+        if total >= SPARSE_MAX_CELLS:
+            raise ValueError("%s elements do not fit in int64" % total)
+        self.total = total
+    
+    def encode(self, digits):
+        result = np.zeros((), dtype=np.int64)
+        for d, w in zip(digits, self.weights):
+            result = result + np.asarray(d, dtype=np.int64) * w
+        return result
+    
+    def digit(self, codes, i):
+        return (np.asarray(codes, dtype=np.int64) // self.weights[i]) % self.sizes[i]
+    
+    def decode(self, codes):
+        return [self.digit(codes, i) for i in range(len(self.sizes))]
+
+
+def _sorted_positions(sub, values):
+    """
+    Posicion de cada valor en el array ordenado sub, -1 si no esta
+    """
+    positions = np.searchsorted(sub, values)
+    inside = positions < len(sub)
+    positions = np.where(inside, positions, 0)
+    found = inside & (values >= 0) & (sub[positions] == values) if len(sub) else inside
+    return np.where(found, positions, -1)
+
+
+def _any_undefined(arrays):
+    """
+    Array booleano (con broadcasting) de donde algun array de indices es -1
+    """
+    return reduce(np.logical_or, [np.asarray(a) < 0 for a in arrays], np.zeros((), dtype=np.bool_))
+
+
+def _relation_from_table(sym, arity, table, universe):
+    """
+    Relation sobre universe a partir de su tensor booleano, guardada como
+    diga choose_storage (denso o ralo)
+    """
+    result = Relation(sym, arity)
+    storage = choose_storage(len(universe), arity, int(np.count_nonzero(table)))
+    if storage == "dense":
+        result._set_storage(_DenseRelation(table), universe)
+    else:
+        idx = np.argwhere(table)
+        result._set_storage(_SparseRelation(None, len(universe), arity).from_indices(idx), universe)
+    return result
+
+
+class _VcallOperation(object):
+    """
+    Base de las operaciones perezosas (vistas y productos), que no tienen
+    tabla (table es None): las subclases solo definen vcall sobre arrays
+    de indices y lo demas sale de ahi
+    """
+    
+    table = None
+    
+    def icall(self, *args):
+        return int(self.vcall(*args))
+    
+    def _grid(self, sub):
+        return self.vcall(*np.ix_(*[sub] * self.arity))
+    
+    def dense_table(self):
+        """
+        Tabla de Cayley armada con vcall sobre todo universe^arity
+        """
+        return np.asarray(self._grid(np.arange(len(self.universe))), dtype=np.intp)
+    
+    def __call__(self, *args):
+        result = self.icall(*[self.index[a] for a in args])
+        if result < 0:
+            raise KeyError(args)
+        return self.universe[result]
+    
+    def items(self):
+        for t in product(range(len(self.universe)), repeat=self.arity):
+            v = self.icall(*t)
+            if v >= 0:
+                yield tuple(self.universe[i] for i in t), self.universe[v]
+    
+    def __len__(self):
+        return int(np.count_nonzero(self.dense_table() >= 0))
+    
+    def __repr__(self):
+        return "%s : %s" % (self.sym, dict(self.items()))
+    
+    def restrict(self, subuniverse):
+        sub = _subuniverse(self.index, subuniverse)
+        universe = [self.universe[i] for i in sub]
+        result = Operation(self.sym, self.arity)
+        result._set_table(_sorted_positions(sub, self._grid(sub)).astype(np.intp), universe,
+                          {e: i for i, e in enumerate(universe)})
+        return result
+
+
+class _VcallRelation(object):
+    """
+    Base de las relaciones perezosas (vistas y productos), sin storage:
+    las subclases solo definen vcall sobre arrays de indices
+    """
+    
+    storage = None
+    formula = None
+    
+    def icall(self, *args):
+        return bool(self.vcall(*args))
+    
+    def _grid(self, sub):
+        return np.asarray(self.vcall(*np.ix_(*[sub] * self.arity)), dtype=np.bool_)
+    
+    def _table(self):
+        """
+        Tensor booleano de la relacion sobre universe^arity
+        """
+        return self._grid(np.arange(len(self.universe)))
+    
+    def __call__(self, *args):
+        try:
+            return self.icall(*[self.index[a] for a in args])
+        except KeyError:
+            return False
+    
+    def __iter__(self):
+        universe = self.universe
+        return (tuple(universe[i] for i in t) for t in np.argwhere(self._table()).tolist())
+    
+    def __len__(self):
+        return int(np.count_nonzero(self._table()))
+    
+    def index_array(self):
+        """
+        Array (len, arity) con las tuplas de indices de la relacion
+        """
+        return np.argwhere(self._table())
+    
+    def __repr__(self):
+        return "%s : %s" % (self.sym, set(self))
+    
+    def restrict(self, subuniverse):
+        sub = _subuniverse(self.index, subuniverse)
+        return _relation_from_table(self.sym, self.arity, self._grid(sub), [self.universe[i] for i in sub])
+
+
+class _OperationView(_VcallOperation):
+    """
+    Operacion de un SubmodelView: traduce los indices del submodelo a los
+    del padre (sub) y el resultado de vuelta con busqueda binaria; lo que
+    cae fuera de sub, o tiene algun argumento en -1, queda en -1. No copia
+    la tabla; padded es _with_undefined(sub), compartido por todas las
+    vistas del submodelo
+    """
+    
+    def __init__(self, op, sub, padded, universe, index):
+        self.op = op
+        self.sym = op.sym
+        self.arity = op.arity
+        self.sub = sub
+        self.padded = padded
+        self.universe = universe
+        self.index = index
+    
+    def vcall(self, *arrays):
+        result = _sorted_positions(self.sub, np.asarray(self.op.vcall(*[self.padded[a] for a in arrays])))
+        return np.where(_any_undefined(arrays), -1, result)
+
+
+class _RelationView(_VcallRelation):
+    """
+    Relacion de un SubmodelView: pregunta al padre traduciendo los indices
+    (una tupla con algun -1 no esta)
+    """
+    
+    def __init__(self, rel, sub, padded, universe, index):
+        self.rel = rel
+        self.sym = rel.sym
+        self.arity = rel.arity
+        self.sub = sub
+        self.padded = padded
+        self.universe = universe
+        self.index = index
+    
+    def vcall(self, *arrays):
+        inside = np.asarray(self.rel.vcall(*[self.padded[a] for a in arrays]), dtype=np.bool_)
+        return inside & ~_any_undefined(arrays)
+
+
+class _ProductOperation(_VcallOperation):
+    """
+    Operacion de un producto directo sobre los codigos en base mixta de sus
+    elementos: se decodifican los argumentos y se aplican las tablas de los
+    factores coordenada a coordenada. items, len y repr salen de los
+    factores, sin recorrer universe^arity
+    """
+    
+    def __init__(self, sym, arity, factors, radix, universe, index):
+        self.sym = sym
+        self.arity = arity
+        self.factors = factors
+        self.radix = radix
+        self.universe = universe
+        self.index = index
+    
+    def vcall(self, *arrays):
+        digits = [self.radix.decode(a) for a in arrays]
+        results = [np.asarray(f.vcall(*[d[j] for d in digits])) for j, f in enumerate(self.factors)]
+        undefined = reduce(np.logical_or, [r < 0 for r in results], np.zeros((), dtype=np.bool_))
+        return np.where(undefined, -1, self.radix.encode(results))
+    
+    def items(self):
+        for pairs in product(*[f.items() for f in self.factors]):
+            args = zip(*[[f.index[a] for a in t] for f, (t, _) in zip(self.factors, pairs)])
+            yield (tuple(int(self.radix.encode(a)) for a in args),
+                   int(self.radix.encode([f.index[v] for f, (_, v) in zip(self.factors, pairs)])))
+    
+    def __len__(self):
+        return reduce(lambda x, y: x * y, [len(f) for f in self.factors], 1)
+    
+    def __repr__(self):
+        return "%s : %s" % (self.sym, " x ".join("<%s>" % len(f.universe) for f in self.factors))
+
+
+class _ProductRelation(_VcallRelation):
+    """
+    Relacion de un producto directo: una tupla de codigos esta si cada
+    coordenada esta en la relacion del factor correspondiente
+    """
+    
+    def __init__(self, sym, arity, factors, radix, universe, index):
+        self.sym = sym
+        self.arity = arity
+        self.factors = factors
+        self.radix = radix
+        self.universe = universe
+        self.index = index
+    
+    def vcall(self, *arrays):
+        digits = [self.radix.decode(a) for a in arrays]
+        return reduce(np.logical_and,
+                      [np.asarray(f.vcall(*[d[j] for d in digits])) for j, f in enumerate(self.factors)],
+                      np.ones((), dtype=np.bool_))
+    
+    def __iter__(self):
+        for ts in product(*self.factors):
+            digits = zip(*[[f.index[a] for a in t] for f, t in zip(self.factors, ts)])
+            yield tuple(int(self.radix.encode(d)) for d in digits)
+    
+    def __len__(self):
+        return reduce(lambda x, y: x * y, [len(f) for f in self.factors], 1)
+    
+    def index_array(self):
+        """
+        Producto de los index_array de los factores, codificado columna a
+        columna
+        """
+        arrays = [f.index_array() for f in self.factors]
+        rows = np.indices([len(a) for a in arrays]).reshape(len(arrays), -1)
+        columns = [self.radix.encode([a[r, c] for a, r in zip(arrays, rows)]) for c in range(self.arity)]
+        return np.array(columns, dtype=np.intp).T.reshape(rows.shape[1], self.arity)
+    
+    def __repr__(self):
+        return "%s : %s" % (self.sym, " x ".join(str(f.sym) for f in self.factors))
+
+
 def FO_Operation_decorator(d_universe, arity=None):
     """
     Decorador para definir facilmente operaciones de primer orden
@@ -2,27 +2,58 @@
 # -*- coding: utf8 -*-
 
 from fopy.first_order import Relation
+from fopy.first_order._relops import CHUNK_CELLS, _with_undefined
 from fopy.misc.misc import indent
 from fopy.misc.myunicode import subscript
 from fopy.interfaces.minion import MinionSol
 from itertools import combinations, product, chain
 from functools import lru_cache
-from functools import reduce, total_ordering
+from functools import total_ordering
+from collections import defaultdict
+import copy
 
-
-class _CardinalBlock(object):
-    def __init__(self, value):
-        self.value = value
+import numpy as np
 
 
 class Partition(object):
-    def __init__(self, iter_of_iter=()):
-        self.v = dict()
+    """
+    Particion de universe (por defecto, los elementos que aparecen en
+    iter_of_iter) como union-find sobre los indices 0..n-1: parent es el
+    array de padres y size el de tamaños (solo vale en las raices)
+
+    >>> p = Partition([(0, 2), (1, 3)], [0, 1, 2, 3])
+    >>> p(0, 2), p(0, 1)
+    (True, False)
+    >>> p.join(Partition([(2, 3)], [0, 1, 2, 3]))
+    [|0, 1, 2, 3|]
+    >>> p.meet(Partition([(0, 1), (2, 3)], [0, 1, 2, 3]))
+    [|0|, |1|, |2|, |3|]
+    """
+    
+    def __init__(self, iter_of_iter=(), universe=None):
+        if universe is None:
+            iter_of_iter = list(iter_of_iter)
+            universe = list(dict.fromkeys(e for t in iter_of_iter for e in t))
+        self.universe = list(universe)
+        self.index = {e: i for i, e in enumerate(self.universe)}
+        self.parent = np.arange(len(self.universe), dtype=np.intp)
+        self.size = np.ones(len(self.universe), dtype=np.intp)
+        self._ids = None
+        self._key = None
+        self._members = None
+        self._blocks = None
         self.from_table(iter_of_iter)
     
     def __call__(self, a, b):
         return self.root(a) == self.root(b)
     
+    def __contains__(self, pair):
+        a, b = pair
+        return self(a, b)
+    
+    def __len__(self):
+        return len(self.universe)
+    
     def from_table(self, l):
         for a, b in l:
             self.add_element(a)
@@ -31,15 +62,14 @@ class Partition(object):
     
     def table(self):
         result = set()
-        for a in self.v:
-            for b in self.v:
-                if self(a, b):
-                    result.add((a, b))
+        for b in self.iter_blocks():
+            result.update(product(b, repeat=2))
         return result
     
     def copy(self):
-        result = Partition()
-        result.v = self.v.copy()
+        result = copy.copy(self)
+        result.parent = self.parent.copy()
+        result.size = self.size.copy()
         return result
     
     def from_blocks(self, ls):
@@ -53,40 +83,78 @@ class Partition(object):
                 self.add_element(e)
                 self.join_blocks(e, l[0])
     
+    def from_ids(self, ids):
+        """
+        Reemplaza la particion por la que junta los elementos con el mismo
+        valor en ids (un array con un valor por elemento del universo)
+        """
+        _, first, inverse, counts = np.unique(ids, return_index=True,
+                                              return_inverse=True, return_counts=True)
+        self.parent = first[inverse.ravel()].astype(np.intp)
+        self.size = counts[inverse.ravel()].astype(np.intp)
+        self._invalidate()
+    
     def add_element(self, e):
-        if e not in self.v:
-            self.v[e] = _CardinalBlock(-1)
+        if e not in self.index:
+            self.index = dict(self.index)
+            self.index[e] = len(self.universe)
+            self.universe = self.universe + [e]
+            self.parent = np.append(self.parent, len(self.parent))
+            self.size = np.append(self.size, 1)
+            self._invalidate()
+    
+    def _find(self, i):
+        """
+        Raiz del indice i, comprimiendo el camino (iterativo)
+        """
+        parent = self.parent
+        r = i
+        while parent[r] != r:
+            r = parent[r]
+        while parent[i] != r:
+            parent[i], i = r, parent[i]
+        return r
+    
+    def _union(self, i, j):
+        """
+        Une los bloques de los indices i y j, colgando la raiz del bloque
+        mas chico de la del mas grande
+        """
+        ri = self._find(i)
+        rj = self._find(j)
+        if ri != rj:
+            if self.size[ri] < self.size[rj]:
+                ri, rj = rj, ri
+            self.parent[rj] = ri
+            self.size[ri] += self.size[rj]
+            self._invalidate()
+    
+    def roots(self):
+        """
+        Array con la raiz de cada indice (comprime todos los caminos)
+        """
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+        self.parent = parent
+        return parent
     
     def root(self, e):
         """
         Representante de la clase de equivalencia de e
         """
-        # TODO NO DEBERIA SER RECURSIVO
-        # deberia avanzar recordando los que no tienen al root como padre y acomodar todo al final
-        if self.is_root(e):
-            return e
-        else:
-            self.v[e] = self.root(self.v[e])
-            return self.v[e]
+        return self.universe[self._find(self.index[e])]
     
     def join_blocks(self, i, j):
-        
-        ri = self.root(i)
-        rj = self.root(j)
-        if ri != rj:
-            si = self.v[ri].value
-            sj = self.v[rj].value
-            if si < sj:
-                self.v[i] = rj
-                self.v[j] = _CardinalBlock(si + sj)
-            else:
-                self.v[j] = ri
-                self.v[i] = _CardinalBlock(si + sj)
+        self._union(self.index[i], self.index[j])
     
     def to_list(self):
         result = defaultdict(list)
-        for e in self.v:
-            result[self.root(e)].append(e)
+        for e, r in zip(self.universe, self.roots().tolist()):
+            result[r].append(e)
         return list(result.values())
     
     def __repr__(self):
@@ -95,25 +163,18 @@ class Partition(object):
     
     def meet(self, other):
         """
+        Los bloques de la interseccion son los pares de raices distintos;
+        la raiz de cada uno es su primer elemento
 
         :type other: Partition
         """
-        result = Partition()
-        ht = dict()
-        for e in self.v:
-            r1 = self.root(e)
-            r2 = other.root(e)
-            if (r1, r2) in ht:
-                r = ht[r1, r2]
-                result.v[r] = _CardinalBlock(result.v[r].value + 1)
-                result.v[e] = r
-            else:
-                ht[(r1, r2)] = e
-                result.v[e] = _CardinalBlock(-1)
+        result = self.copy()
+        result.from_ids(self.roots() * len(self.universe) + other.roots())
         return result
     
     def is_root(self, e):
-        return isinstance(self.v[e], _CardinalBlock)
+        i = self.index[e]
+        return self.parent[i] == i
     
     def join(self, other):
         """
@@ -123,32 +184,129 @@ class Partition(object):
         :type other: Partition
         """
         result = other.copy()
-        for e in self.v:
-            if not self.is_root(e):  # not a root
-                result.join_blocks(e, self.root(e))
+        roots = self.roots()
+        for i in np.flatnonzero(roots != np.arange(len(roots))).tolist():
+            result._union(i, roots[i])
         return result
     
     def iter_tuples(self):
-        for a in self.v:
-            for b in self.v:
-                if self(a, b):
-                    yield (a, b)
+        ids = self.block_ids().tolist()
+        members = self.members()
+        for i, a in enumerate(self.universe):
+            for j in members[ids[i]]:
+                yield (a, self.universe[j])
+    
+    def members(self):
+        """
+        Lista con los indices (ordenados) de cada bloque, por id de bloque
+
+        >>> p = Partition([(3, 1), (2, 0)], [0, 1, 2, 3, 4])
+        >>> p.block_ids().tolist(), p.members(), p.representatives().tolist()
+        ([0, 1, 0, 1, 2], [[0, 2], [1, 3], [4]], [0, 1, 4])
+        >>> p.block(3) == {1, 3}, list(p.iter_blocks())[2], p.block_count()
+        (True, frozenset({4}), 3)
+        >>> sorted(p.iter_tuples()) == sorted(p.table()), len(p.table())
+        (True, 9)
+        >>> p.join_blocks(4, 0)
+        >>> p.members(), p.block(4) == {0, 2, 4}, p.representatives().tolist()
+        ([[0, 2, 4], [1, 3]], True, [0, 1])
+        """
+        if self._members is None:
+            ids = self.block_ids()
+            order = np.argsort(ids, kind="stable")
+            bounds = np.cumsum(np.bincount(ids, minlength=self.block_count()))[:-1]
+            self._members = [m.tolist() for m in np.split(order, bounds)]
+        return self._members
+    
+    def _block(self, b):
+        if self._blocks is None:
+            self._blocks = [None] * self.block_count()
+        if self._blocks[b] is None:
+            self._blocks[b] = frozenset(self.universe[i] for i in self.members()[b])
+        return self._blocks[b]
     
     def block(self, e):
-        result = set()
-        r = self.root(e)
-        for i in self.v:
-            if self.root(i) == r:
-                result.add(i)
-        return frozenset(result)
+        return self._block(self.block_ids()[self.index[e]])
     
     def iter_blocks(self):
-        for e in self.v:
-            if self.is_root(e):
-                yield self.block(e)
+        for b in range(self.block_count()):
+            yield self._block(b)
+    
+    def block_count(self):
+        return int(self.block_ids().max()) + 1 if len(self.universe) else 0
+    
+    def representatives(self):
+        """
+        Array con el indice del primer elemento de cada bloque, por id de bloque
+        """
+        return np.unique(self.block_ids(), return_index=True)[1]
+    
+    def _invalidate(self):
+        self._ids = None
+        self._key = None
+        self._members = None
+        self._blocks = None
+    
+    def block_ids(self):
+        """
+        Vector canonico de ids de bloque (restricted growth): el bloque del
+        indice i es el numero de bloques distintos que aparecen antes de su
+        primer elemento. No depende del orden de las uniones
+        """
+        if self._ids is None:
+            roots = self.roots()
+            _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+            rank = np.empty(len(first), dtype=np.intp)
+            rank[np.argsort(first)] = np.arange(len(first))
+            self._ids = rank[inverse.ravel()]
+            self._ids.setflags(write=False)
+        return self._ids
+    
+    def key(self):
+        """
+        block_ids como bytes, base del hash y la igualdad
+        """
+        if self._key is None:
+            self._key = self.block_ids().tobytes()
+        return self._key
     
     def __hash__(self):
-        return hash(frozenset(self.v.items()))
+        return hash(self.key())
+    
+    def __eq__(self, other):
+        if not isinstance(other, Partition):
+            return NotImplemented
+        return self.universe == other.universe and self.key() == other.key()
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __le__(self, other):
+        """
+        Refinamiento en O(n): self <= other si cada elemento esta en el
+        mismo bloque de other que la raiz de su bloque en self
+
+        >>> Partition([(0, 1)], [0, 1, 2]) <= Partition([(0, 1), (1, 2)], [0, 1, 2])
+        True
+        >>> Partition([(0, 2)], [0, 1, 2]) < Partition([(0, 1)], [0, 1, 2])
+        False
+        """
+        if self.universe != other.universe:
+            raise ValueError("Partitions over different universes")
+        ids = other.block_ids()
+        return bool(np.array_equal(ids[self.roots()], ids))
+    
+    def __lt__(self, other):
+        return self <= other and self.key() != other.key()
+    
+    def __ge__(self, other):
+        return other <= self
+    
+    def __gt__(self, other):
+        return other < self
 
 
 class Congruence(Partition):
@@ -167,25 +325,11 @@ class Congruence(Partition):
     
     def __init__(self, table, model):
         self.model = model
-        super(Congruence, self).__init__(table)
+        super(Congruence, self).__init__(table, model.universe)
         # assert self.preserva_operaciones()
     
-    def __preserva_operacion(self, op):
-        if self.model.operations[op].arity() == 0:
-            pass
-        else:
-            for t in self.model.operations[op].domain():
-                for s in self.model.operations[op].domain():
-                    if self(t, s):
-                        if not self(self.model.operations[op](*t), self.model.operations[op](*s)):
-                            return False
-        return True
-    
     def preserva_operaciones(self):
-        result = True
-        for op in self.model.operations:
-            result = result and self.__preserva_operacion(op)
-        return result
+        return compatibility_witness(self.model, self, relations=False) is None
 
     def classes(self):
         return self.iter_blocks()
@@ -207,29 +351,20 @@ class Congruence(Partition):
         assert self.model == other.model
         return self.join(other)
     
-    def __lt__(self, other):
-        if self & other == self and self != other:
-            return True
-        return False
-    
     def __eq__(self, other):
-        if self.model != other.model:
-            return False
-        if self.v != set(other.v):
+        if isinstance(other, Congruence) and self.model != other.model:
             return False
-        return True
-
-    def __le__(self, other):
-        return self == other or self <= other
+        return super(Congruence, self).__eq__(other)
     
-    def __ge__(self, other):
-        return other <= self
+    def __hash__(self):
+        return super(Congruence, self).__hash__()
     
-    def __gt__(self, other):
-        return other < self
+    def __le__(self, other):
+        assert self.model == other.model
+        return super(Congruence, self).__le__(other)
     
     def __repr__(self):
-        return "Congruence(" + repr(super(Congruence, self)) + ")"
+        return "Congruence(" + super(Congruence, self).__repr__() + ")"
 
 
 class CongruenceSystem(object):
@@ -277,9 +412,217 @@ class CongruenceSystem(object):
             return True
 
 
+def _class_bits(congruence):
+    """
+    Clases de la congruencia como matriz de bits empaquetados
+    (np.packbits): la fila b tiene prendidos los elementos del bloque b
+    """
+    ids = congruence.block_ids()
+    n = len(ids)
+    members = np.zeros((congruence.block_count(), n), dtype=bool)
+    members[ids, np.arange(n)] = True
+    return np.packbits(members, axis=1)
+
+
+class SystemSolver(object):
+    """
+    Resuelve en tanda sistemas de congruencias sobre una lista fija de
+    congruencias (con supremos x | y, o sup_proj(sigma, x, y) si se da
+    sigma). Precalcula los ids de bloque de cada congruencia, sus clases
+    como bits empaquetados (np.packbits) y los ids de bloque de cada
+    supremo de a pares; un vector de elementos es una fila de vectors
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> S = SystemSolver([Cg(M, [(0, 2)]), mincon(M)])
+    >>> S.check([(0, 2), (0, 1)])
+    array([ True, False])
+    >>> S.solve([(0, 2), (0, 1)])
+    (array([ True, False]), [2, None])
+    """
+    
+    def __init__(self, congruences, sigma=None):
+        assert congruences and isinstance(congruences, list)
+        self.model = congruences[0].model
+        self.cong = congruences
+        self.sigma = sigma
+        n = len(self.model.universe)
+        self.ids = np.array([c.block_ids() for c in congruences]).reshape(len(congruences), n)
+        self.classes = [_class_bits(c) for c in congruences]
+        self.joins = {}
+        for i, j in combinations(range(len(congruences)), 2):
+            if sigma:
+                join = sup_proj(sigma, congruences[i], congruences[j])
+            else:
+                join = congruences[i] | congruences[j]
+            self.joins[(i, j)] = join.block_ids()
+    
+    def _indices(self, vectors, indices):
+        if indices:
+            return np.asarray(vectors, dtype=np.intp).reshape(-1, len(self.cong))
+        index = self.model.index
+        return np.array([[index[e] for e in v] for v in vectors],
+                        dtype=np.intp).reshape(-1, len(self.cong))
+    
+    def check(self, vectors, indices=False):
+        """
+        Array booleano: si cada vector es un sistema (cada par de
+        coordenadas relacionado por el supremo de sus congruencias)
+        """
+        vectors = self._indices(vectors, indices)
+        result = np.ones(len(vectors), dtype=bool)
+        for (i, j), join in self.joins.items():
+            result &= join[vectors[:, i]] == join[vectors[:, j]]
+        return result
+    
+    def solve(self, vectors, indices=False):
+        """
+        Devuelve un array booleano con si la interseccion de las clases de
+        cada vector es no vacia y una solucion de cada uno (la menor, o
+        None; con indices, el indice o -1)
+        """
+        vectors = self._indices(vectors, indices)
+        bits = None
+        for i, classes in enumerate(self.classes):
+            chosen = classes[self.ids[i][vectors[:, i]]]
+            bits = chosen if bits is None else bits & chosen
+        bits = np.unpackbits(bits, axis=1, count=len(self.model.universe)).astype(bool)
+        solvable = bits.any(axis=1)
+        solutions = np.where(solvable, bits.argmax(axis=1), -1)
+        if indices:
+            return solvable, solutions
+        universe = self.model.universe
+        return solvable, [universe[e] if e >= 0 else None for e in solutions.tolist()]
+
+
+def compatibility_witness(model, partition, relations=True):
+    """
+    Decide si partition (sobre model.universe) es compatible con las
+    operaciones y, si relations, con las relaciones del modelo (cada
+    relacion es union de productos de bloques). Devuelve None si lo es o
+    un testigo (sym, t, s) con t y s tuplas coordenada a coordenada
+    equivalentes tales que f(t) y f(s) no lo son (o t esta en la relacion
+    y s no).
+    Para cada operacion se pasan los resultados a ids de bloque y se
+    compara, para cada posicion, con la tabla que tiene en esa posicion al
+    representante del bloque del argumento; en las relaciones se cuentan
+    las tuplas de cada tupla de bloques contra el producto de sus tamaños
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> compatibility_witness(M, Partition([(0, 2), (1, 3)], M.universe)) is None
+    True
+    >>> compatibility_witness(M, Partition([(0, 1)], M.universe))
+    ('+', (1, 1), (0, 1))
+    >>> from fopy.first_order._models import Product
+    >>> P = Product([cyclic_group(2), cyclic_group(2)])
+    >>> compatibility_witness(P, Partition([(0, 3)], P.universe))
+    ('+', (3, 1), (0, 1))
+    """
+    universe = model.universe
+    ids = partition.block_ids()
+    reps = partition.representatives()[ids]
+    blocks = _with_undefined(ids)
+    for sym, op in model.operations.items():
+        if not op.arity:
+            continue
+        results = blocks[op.dense_table()]
+        for p in range(op.arity):
+            moved = np.take(results, reps, axis=p)
+            differ = np.argwhere(results != moved)
+            if len(differ):
+                t = differ[0].tolist()
+                s = list(t)
+                s[p] = int(reps[t[p]])
+                return sym, tuple(universe[i] for i in t), tuple(universe[i] for i in s)
+    if not relations:
+        return None
+    sizes = np.bincount(ids)
+    for sym, rel in model.relations.items():
+        if not rel.arity:
+            continue
+        idx = rel.index_array()
+        rows, first, counts = np.unique(ids[idx], axis=0, return_index=True, return_counts=True)
+        bad = np.flatnonzero(counts != sizes[rows].prod(axis=1))
+        if len(bad):
+            t = idx[first[bad[0]]].tolist()
+            members = partition.members()
+            for s in product(*[members[b] for b in rows[bad[0]].tolist()]):
+                if not rel.icall(*s):
+                    return sym, tuple(universe[i] for i in t), tuple(universe[i] for i in s)
+    return None
+
+
+def Cg(model, pairs):
+    """
+    Congruencia generada por pairs (pares de elementos del universo).
+    Union-find con lista de trabajo: cada par que une dos bloques se
+    propaga por las traslaciones de todas las operaciones, comparando
+    vectorizado f(.., a, ..) con f(.., b, ..) en cada posicion (por tandas
+    de pares pendientes), hasta que no se une nada mas. root guarda la
+    raiz de cada elemento y al unir se reetiqueta el bloque mas chico.
+    Si queda un solo bloque se corta
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> Cg(cyclic_group(4), [(0, 2)])
+    Congruence([|0, 2|, |1, 3|])
+
+    Sobre un producto perezoso la tabla sale de dense_table:
+
+    >>> from fopy.first_order._models import Product
+    >>> P = Product([cyclic_group(2), cyclic_group(2)])
+    >>> Cg(P, [(0, 1)]), len(CongruenceLattice(P))
+    (Congruence([|0, 1|, |2, 3|]), 5)
+    """
+    n = len(model.universe)
+    root = np.arange(n, dtype=np.intp)
+    members = [[i] for i in range(n)]
+    tables = [op.dense_table() for op in model.operations.values() if op.arity]
+    pending = []
+    blocks = [n]
+    
+    def union(a, b):
+        ra, rb = root[a], root[b]
+        if ra == rb:
+            return
+        if len(members[ra]) < len(members[rb]):
+            ra, rb = rb, ra
+        root[members[rb]] = ra
+        members[ra] += members[rb]
+        members[rb] = None
+        blocks[0] -= 1
+        pending.append((a, b))
+    
+    for a, b in pairs:
+        union(model.index[a], model.index[b])
+    while pending and blocks[0] > 1:
+        batch = np.array(pending, dtype=np.intp)
+        del pending[:]
+        for table in tables:
+            step = max(1, CHUNK_CELLS // max(1, n ** (table.ndim - 1)))
+            for i in range(0, len(batch), step):
+                a, b = batch[i:i + step].T
+                for p in range(table.ndim):
+                    if blocks[0] == 1:
+                        break
+                    ta = np.take(table, a, axis=p).ravel()
+                    tb = np.take(table, b, axis=p).ravel()
+                    defined = (ta >= 0) & (tb >= 0)
+                    ta, tb = ta[defined], tb[defined]
+                    differ = root[ta] != root[tb]
+                    for x, y in zip(ta[differ].tolist(), tb[differ].tolist()):
+                        union(x, y)
+    result = Congruence((), model)
+    result.parent = root
+    result.size = np.bincount(root, minlength=n).astype(np.intp)
+    result._invalidate()
+    return result
+
+
 def maxcon(model):
-    univ = [(x, y) for x in model.universe for y in model.universe]
-    return Congruence(univ, model)
+    result = Congruence((), model)
+    result.from_ids(np.zeros(len(model.universe), dtype=np.intp))
+    return result
 
 
 def mincon(model):
@@ -287,16 +630,202 @@ def mincon(model):
     return Congruence(univ, model)
 
 
+def _order_matrix(partitions):
+    """
+    Matriz booleana leq[i, j] = partitions[i] <= partitions[j], con los
+    vectores de bloques apilados
+    """
+    m = len(partitions)
+    n = len(partitions[0]) if m else 0
+    ids = np.array([c.block_ids() for c in partitions]).reshape(m, n)
+    roots = np.array([c.roots() for c in partitions]).reshape(m, n)
+    return np.array([(ids[:, r] == ids).all(axis=1) for r in roots], dtype=bool).reshape(m, m)
+
+
+class CongruenceLattice(object):
+    """
+    Reticulado de congruencias de un modelo. Se arma con las congruencias
+    principales cerrando por supremos con ellas (sin repetir, por key) y
+    los elementos quedan ordenados por cantidad de bloques decreciente
+    (bottom primero, top ultimo). leq es la matriz del orden y join_table
+    y meet_table las tablas de supremo e infimo, sobre los indices
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> L = CongruenceLattice(cyclic_group(4))
+    >>> len(L), L.atoms(), L.join_irreducibles()
+    (3, [1], [1, 2])
+    >>> L.monolith()
+    Congruence([|0, 2|, |1, 3|])
+    >>> L.join(1, 2), L.meet(1, 2)
+    (2, 1)
+    """
+    
+    def __init__(self, model):
+        self.model = model
+        n = len(model.universe)
+        bottom = mincon(model)
+        self.principals = {}
+        found = {bottom.key(): bottom}
+        for a, b in combinations(range(n), 2):
+            c = Cg(model, [(model.universe[a], model.universe[b])])
+            c = found.setdefault(c.key(), c)
+            self.principals[(a, b)] = c
+        principals = list({c.key(): c for c in self.principals.values()}.values())
+        frontier = list(found.values())
+        while frontier:
+            new = []
+            for c in frontier:
+                for p in principals:
+                    j = c.join(p)
+                    if j.key() not in found:
+                        found[j.key()] = j
+                        new.append(j)
+            frontier = new
+        self.elements = sorted(found.values(), key=lambda c: -c.block_count())
+        self.index = {c.key(): i for i, c in enumerate(self.elements)}
+        self.principals = {ab: self.index[c.key()] for ab, c in self.principals.items()}
+        
+        m = len(self.elements)
+        self.leq = _order_matrix(self.elements)
+        self.join_table = np.empty((m, m), dtype=np.intp)
+        self.meet_table = np.empty((m, m), dtype=np.intp)
+        for i in range(m):
+            self.join_table[i] = np.argmax(self.leq[i] & self.leq, axis=1)
+            lower = self.leq[:, i] & self.leq.T
+            self.meet_table[i] = m - 1 - np.argmax(lower[:, ::-1], axis=1)
+        lt = self.leq & ~np.eye(m, dtype=bool)
+        self.cover = lt & ~((lt.astype(np.intp) @ lt.astype(np.intp)) > 0)
+        self.bottom = 0
+        self.top = m - 1
+    
+    def __len__(self):
+        return len(self.elements)
+    
+    def __iter__(self):
+        return iter(self.elements)
+    
+    def __getitem__(self, i):
+        return self.elements[i]
+    
+    def position(self, congruence):
+        """
+        Indice de una congruencia del modelo en el reticulado
+        """
+        return self.index[congruence.key()]
+    
+    def principal(self, a, b):
+        """
+        Indice de Cg(a, b)
+        """
+        a, b = sorted((self.model.index[a], self.model.index[b]))
+        if a == b:
+            return self.bottom
+        return self.principals[(a, b)]
+    
+    def join(self, i, j):
+        return int(self.join_table[i, j])
+    
+    def meet(self, i, j):
+        return int(self.meet_table[i, j])
+    
+    def upper_covers(self, i):
+        return np.flatnonzero(self.cover[i]).tolist()
+    
+    def lower_covers(self, i):
+        return np.flatnonzero(self.cover[:, i]).tolist()
+    
+    def atoms(self):
+        return self.upper_covers(self.bottom)
+    
+    def coatoms(self):
+        return self.lower_covers(self.top)
+    
+    def join_irreducibles(self):
+        return np.flatnonzero(self.cover.sum(axis=0) == 1).tolist()
+    
+    def meet_irreducibles(self):
+        return np.flatnonzero(self.cover.sum(axis=1) == 1).tolist()
+    
+    def monolith(self):
+        """
+        Menor congruencia no trivial, si existe (el modelo es
+        subdirectamente irreducible); si no None
+        """
+        atoms = self.atoms()
+        if len(atoms) == 1:
+            return self.elements[atoms[0]]
+        return None
+    
+    def __repr__(self):
+        return "CongruenceLattice(%s)" % self.elements
+
+
 def sup_proj(sigma, x, y):
     """
     Devuelve el supremo entre x e y dentro del reticulado de congruencias
     generado por el conjunto sigma
     """
-    xy_up = {c for c in sigma if (set(x.d) <= set(c.d) and set(y.d) <= set(c.d))}
-    e = maxcon(x.model)
-    for r in xy_up:
-        e = e & r
-    return e
+    e = None
+    for c in sigma:
+        if x <= c and y <= c:
+            e = c.copy() if e is None else e & c
+    return maxcon(x.model) if e is None else e
+
+
+def unsolvable_system(sigma):
+    """
+    Busca un sistema de congruencias de minorice(sigma) (con los supremos
+    de sup_proj) sin solucion y lo devuelve como CongruenceSystem, o None
+    si todos tienen solucion.
+    Un sistema solo depende de las clases elegidas, asi que se recorren
+    tuplas de clases: en cada nivel solo quedan las clases que estan en el
+    mismo bloque del supremo que las ya elegidas, y la solucion es la
+    interseccion de las clases como bits empaquetados (ver _class_bits)
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> unsolvable_system([Cg(M, [(0, 2)])]) is None
+    True
+    """
+    sigma = list(sigma)
+    cong = minorice(sigma)
+    k = len(cong)
+    ids = [c.block_ids() for c in cong]
+    reps = [c.representatives() for c in cong]
+    bits = [_class_bits(c) for c in cong]
+    # joins[j][i]: bloque del supremo de cong[j] y cong[i] de cada clase de
+    # cong[j] y de cong[i], para j < i
+    joins = [[None] * k for _ in range(k)]
+    for j, i in combinations(range(k), 2):
+        J = sup_proj(sigma, cong[j], cong[i]).block_ids()
+        joins[j][i] = (J[reps[j]], J[reps[i]])
+    
+    def candidates(i, chosen):
+        allowed = np.ones(len(bits[i]), dtype=bool)
+        for j, c in enumerate(chosen):
+            on_j, on_i = joins[j][i]
+            allowed &= on_i == on_j[c]
+        return np.flatnonzero(allowed).tolist()
+    
+    if not k:
+        return None
+    full = np.packbits(np.ones(len(cong[0]), dtype=bool))
+    stack = [([], full, candidates(0, []))]
+    while stack:
+        chosen, solutions, pending = stack[-1]
+        if not pending:
+            stack.pop()
+            continue
+        c = pending.pop()
+        new = chosen + [c]
+        new_solutions = solutions & bits[len(chosen)][c]
+        if len(new) == k:
+            if not new_solutions.any():
+                elem = [cong[i].universe[reps[i][c]] for i, c in enumerate(new)]
+                return CongruenceSystem(cong, elem, sigma)
+        else:
+            stack.append((new, new_solutions, candidates(len(new), new)))
+    return None
 
 
 def empty_intersections(con_list):
@@ -426,42 +955,98 @@ def minorice(sigma):
     Dado un conjunto de congruecias devuelve el conjunto minimo
     {tita: tita in sigma tal que no existe delta in sigma con delta contenido en sigma}
     """
-    rem = []
-    sigma = list(set(sigma))
-    for i in list(range(len(sigma))):
-        if i not in rem:
-            for j in range(i + 1, len(sigma)):
-                if sigma[i] & sigma[j] == sigma[j]:
-                    rem.append(i)
-                    break
-                elif sigma[i] & sigma[j] == sigma[i]:
-                    rem.append(j)
-    return [x for x in sigma if sigma.index(x) not in rem]
-
-
-def subspectra(congruences):
-    model = list(congruences)[0].model
-    A_old = [[i] for i in range(len(congruences))]
+    return extremal(sigma)
+
+
+def extremal(congruences, maximal=False):
+    """
+    Elementos minimales (o maximales, si maximal) de una lista de
+    congruencias (o particiones) del mismo universo, sin repetir y en el
+    orden en que aparecen.
+    Se recorren por cantidad de bloques (de mas a menos para los
+    minimales) asi que cada una solo se compara, con los vectores de
+    bloques apilados, contra las ya aceptadas; no se arma ningun infimo
+
+    >>> ps = [Partition(t, [0, 1, 2]) for t in ([(0, 1)], [(0, 1), (1, 2)], [(1, 2)], [(0, 1)])]
+    >>> extremal(ps)
+    [[|0, 1|, |2|], [|0|, |1, 2|]]
+    >>> extremal(ps, maximal=True)
+    [[|0, 1, 2|]]
+    """
+    unique = list({c.key(): c for c in congruences}.values())
+    if not unique:
+        return []
+    order = sorted(range(len(unique)), key=lambda i: unique[i].block_count(), reverse=not maximal)
+    n = len(unique[0])
+    accepted = np.zeros((len(unique), n), dtype=np.intp)
+    k = 0
+    result = []
+    for i in order:
+        c = unique[i]
+        if maximal:
+            ids = accepted[:k]
+            below = (ids[:, c.roots()] == ids).all(axis=1).any()
+        else:
+            ids = c.block_ids()
+            below = (ids[accepted[:k]] == ids).all(axis=1).any()
+        if not below:
+            accepted[k] = c.block_ids() if maximal else c.roots()
+            k += 1
+            result.append(i)
+    return [unique[i] for i in sorted(result)]
+
+
+def subspectra(congruences, max_size=None):
+    """
+    Genera las listas (de al menos 2 congruencias, crecientes en los
+    indices) de congruencias dos a dos incomparables cuya interseccion es
+    la minima, y sus extensiones antichain, por tamaño creciente y hasta
+    max_size elementos.
+    Cada candidata lleva su interseccion y la mascara de bits de sus
+    indices; la incomparabilidad sale de una matriz precalculada
+
+    >>> ps = [Partition(t, [0, 1, 2]) for t in ([(0, 1)], [(1, 2)], [(0, 2)], [(0, 1), (1, 2)])]
+    >>> [[ps.index(c) for c in cs] for cs in subspectra(ps)]
+    [[0, 1], [0, 2], [1, 2], [0, 1, 2]]
+    >>> list(subspectra(ps, max_size=1))
+    []
+    """
+    congruences = list(congruences)
+    m = len(congruences)
+    if not m:
+        return
+    n = len(congruences[0])
+    leq = _order_matrix(congruences)
+    keys = [c.key() for c in congruences]
+    comparable = []
+    for i in range(m):
+        bits = 0
+        for j in np.flatnonzero(leq[i] | leq[:, i]).tolist():
+            if keys[i] != keys[j]:
+                bits |= 1 << j
+        comparable.append(bits)
+    A_old = [([i], 1 << i, congruences[i]) for i in range(m)]
     Adelta_old = []
-    while A_old or Adelta_old:
+    size = 1
+    while (A_old or Adelta_old) and (max_size is None or size < max_size):
+        size += 1
         A = []
         Adelta = []
-        for cs in A_old:
-            for other in range(cs[-1] + 1, len(congruences)):
-                if all(not congruences[other] < congruences[c] and not congruences[c] < congruences[other] for c in cs):
+        for cs, mask, meet in A_old:
+            for other in range(cs[-1] + 1, m):
+                if not mask & comparable[other]:
                     new = cs + [other]
-                    
-                    if reduce(lambda x, y: x & y, [congruences[i] for i in new], ) == mincon(model):
-                        
-                        Adelta.append(new)
+                    new_meet = meet.meet(congruences[other])
+                    if new_meet.block_count() == n:
+                        Adelta.append((new, mask | 1 << other))
                         yield [congruences[i] for i in new]
                     else:
-                        A.append(new)
-        for cs in Adelta_old:
-            for other in range(cs[-1] + 1, len(congruences)):
-                if all(not congruences[other] < congruences[c] and not congruences[c] < congruences[other] for c in cs):
+                        A.append((new, mask | 1 << other, new_meet))
+        for cs, mask in Adelta_old:
+            for other in range(cs[-1] + 1, m):
+                if not mask & comparable[other]:
                     new = cs + [other]
-                    Adelta.append(new)
+                    Adelta.append((new, mask | 1 << other))
                     yield [congruences[i] for i in new]
         A_old = A
         Adelta_old = Adelta
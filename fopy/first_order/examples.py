@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# !/usr/bin/env python
+"""
+Modelos chicos para los ejemplos y doctests
+"""
+
+from fopy.first_order._models import Model
+from fopy.first_order._relops import Operation
+
+
+def cyclic_successor(n, relations=None):
+    """
+    Z_n con la operacion sucesor s(a) = a + 1 mod n
+
+    >>> cyclic_successor(3).operations["s"](2)
+    0
+    """
+    s = Operation("s", 1)
+    for a in range(n):
+        s.add((a, (a + 1) % n))
+    return Model(list(range(n)), {} if relations is None else relations, {"s": s})
+
+
+def cyclic_group(n):
+    """
+    Z_n con la suma modulo n
+
+    >>> cyclic_group(4).operations["+"](3, 2)
+    1
+    """
+    s = Operation("+", 2)
+    for a in range(n):
+        for b in range(n):
+            s.add((a, b, (a + b) % n))
+    return Model(list(range(n)), {}, {"+": s})
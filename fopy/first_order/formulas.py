@@ -4,20 +4,61 @@
 # TERMS
 
 from fopy.misc.myunicode import subscript
+from fopy.first_order._relops import CHUNK_CELLS
 from itertools import product, combinations
 from collections import defaultdict
+from functools import reduce
+from operator import itemgetter
+from weakref import WeakValueDictionary
 
+import numpy as np
 
-class _Term(object):
+
+_nodes = WeakValueDictionary()
+
+
+class _Node(object):
     """
-    Clase general de los terminos de primer orden
+    Nodo de termino o formula. Los nodos se construyen por hash-consing en
+    una tabla debil (_nodes): hay un unico objeto por estructura, asi que
+    la igualdad es identidad y el hash y las variables libres se calculan
+    una sola vez, al crear el nodo
     """
     
-    def __init__(self):
-        pass
+    __slots__ = ("_key", "_hash", "_free_vars", "__weakref__")
+    
+    @classmethod
+    def _intern(cls, *key):
+        """
+        Devuelve el nodo de clase cls con esos campos y si es nuevo; los
+        nodos nuevos los termina de inicializar el __new__ de cada clase
+        """
+        key = (cls,) + key
+        node = _nodes.get(key)
+        if node is not None:
+            return node, False
+        node = object.__new__(cls)
+        node._key = key
+        node._hash = hash(key)
+        _nodes[key] = node
+        return node, True
+    
+    def __hash__(self):
+        return self._hash
+    
+    def __reduce__(self):
+        return type(self), self._key[1:]
     
     def free_vars(self):
-        raise NotImplemented
+        return self._free_vars
+
+
+class _Term(_Node):
+    """
+    Clase general de los terminos de primer orden
+    """
+    
+    __slots__ = ()
     
     def evaluate(self, model, vector):
         """
@@ -25,9 +66,6 @@ class _Term(object):
         """
         raise NotImplemented
     
-    def __hash__(self):
-        raise NotImplemented
-    
     def __le__(self, other):
         if self.grade() == other.grade():
             return repr(self) <= repr(other)
@@ -36,9 +74,6 @@ class _Term(object):
     
     def grade(self):
         raise NotImplemented
-    
-    def __eq__(self, other):
-        return hash(self) == hash(other)
 
 
 class _Variable(_Term):
@@ -46,21 +81,20 @@ class _Variable(_Term):
     Variable de primer orden
     """
     
-    def __init__(self, sym):
+    __slots__ = ("sym",)
+    
+    def __new__(cls, sym):
         if isinstance(sym, int):
-            self.sym = "x" + subscript(sym)
-        else:
-            self.sym = sym
+            sym = "x" + subscript(sym)
+        node, new = cls._intern(sym)
+        if new:
+            node.sym = sym
+            node._free_vars = frozenset([node])
+        return node
     
     def __repr__(self):
         return self.sym
     
-    def __hash__(self):
-        return hash(self.sym)
-    
-    def free_vars(self):
-        return {self}
-    
     def grade(self):
         return 0
     
@@ -69,6 +103,20 @@ class _Variable(_Term):
             return vector[self]
         except KeyError:
             raise ValueError("Free variable %s is not defined" % (self))
+    
+    def _compile(self, model, slots, nslots):
+        try:
+            return itemgetter(slots[self])
+        except KeyError:
+            raise ValueError("Free variable %s is not defined" % (self))
+    
+    def _tensor(self, model, axes, naxes):
+        try:
+            axis = axes[self]
+        except KeyError:
+            raise ValueError("Free variable %s is not defined" % (self))
+        n = len(model.universe)
+        return np.arange(n).reshape((n,) + (1,) * axis)
 
 
 class OpSym(object):
@@ -89,6 +137,9 @@ class OpSym(object):
     def __hash__(self):
         return hash((self.op, self.arity))
     
+    def __eq__(self, other):
+        return isinstance(other, OpSym) and (self.op, self.arity) == (other.op, other.arity)
+    
     def __repr__(self):
         return self.op
 
@@ -98,9 +149,17 @@ class _OpTerm(_Term):
     Termino de primer orden de la aplicacion de una funcion
     """
     
-    def __init__(self, sym, args):
-        self.sym = sym
-        self.args = args
+    __slots__ = ("sym", "args", "_grade")
+    
+    def __new__(cls, sym, args):
+        args = tuple(args)
+        node, new = cls._intern(sym, args)
+        if new:
+            node.sym = sym
+            node.args = args
+            node._free_vars = frozenset().union(*[t.free_vars() for t in args])
+            node._grade = 1 + max([t.grade() for t in args], default=0)
+        return node
     
     def __repr__(self):
         result = repr(self.sym)
@@ -109,23 +168,120 @@ class _OpTerm(_Term):
         result += ")"
         return result
     
-    def __hash__(self):
-        return hash((self.sym, self.args))
-    
     def grade(self):
-        return 1 + max(t.grade() for t in self.args)
-    
-    def free_vars(self):
-        return set.union(*[f.free_vars() for f in self.args])
+        return self._grade
     
     def evaluate(self, model, vector):
-        args = [t.evaluate(model, vector) for t in self.args]
-        return model.operations[self.sym.op](*args)
+        return evaluate_terms([self], model, vector)[0]
+    
+    def _compile(self, model, slots, nslots):
+        op = model.operations[self.sym.op]
+        args = [t._compile(model, slots, nslots) for t in self.args]
+        if op.table is None or (op.table < 0).any():
+            # sin tabla completa: se chequea que este definida
+            icall = op.icall
+            
+            def f(env):
+                result = icall(*[a(env) for a in args])
+                if result < 0:
+                    raise KeyError(tuple(model.universe[a(env)] for a in args))
+                return result
+            return f
+        return _lookup(op.table, args)
+    
+    def _tensor(self, model, axes, naxes):
+        values = {}
+        for t in _dag([self]):
+            if isinstance(t, _Variable):
+                values[t] = t._tensor(model, axes, naxes)
+            else:
+                values[t] = _vcall_defined(model, t.sym.op, [values[a] for a in t.args])
+        return values[self]
+
+
+def _vcall_defined(model, sym, args):
+    """
+    vcall de la operacion sym de model sobre arrays de indices. Si queda
+    algun valor indefinido (-1) levanta KeyError con esos argumentos, como
+    satisfy y compile_formula, en vez de seguir indexando con el -1
+    """
+    result = np.asarray(model.operations[sym].vcall(*args))
+    undefined = result < 0
+    if undefined.any():
+        cell = tuple(np.argwhere(undefined)[0])
+        raise KeyError(tuple(model.universe[np.broadcast_to(a, result.shape)[cell]] for a in args))
+    return result
+
+
+def _dag(terms):
+    """
+    Lista de los subterminos distintos de terms (como los nodos son unicos,
+    los repetidos son el mismo objeto), cada uno despues de sus argumentos
+    """
+    order = []
+    seen = set()
+    stack = [(t, False) for t in reversed(terms)]
+    while stack:
+        t, expanded = stack.pop()
+        if t in seen:
+            continue
+        args = getattr(t, "args", ())
+        if expanded or not args:
+            seen.add(t)
+            order.append(t)
+        else:
+            stack.append((t, True))
+            stack.extend((a, False) for a in reversed(args) if a not in seen)
+    return order
+
+
+def evaluate_terms(terms, model, vector):
+    """
+    Evalua juntos los terminos para el vector de valores, calculando una
+    sola vez cada subtermino compartido
+
+    >>> from fopy.first_order.examples import cyclic_successor
+    >>> M = cyclic_successor(3)
+    >>> x, = variables("x")
+    >>> S = OpSym("s", 1)
+    >>> evaluate_terms([S(x), S(S(x)), x], M, {x: 2})
+    [0, 1, 2]
+    """
+    values = {}
+    for t in _dag(terms):
+        if isinstance(t, _Variable):
+            values[t] = t.evaluate(model, vector)
+        else:
+            values[t] = model.operations[t.sym.op](*[values[a] for a in t.args])
+    return [values[t] for t in terms]
+
+
+def term_tensors(terms, model, vs):
+    """
+    Graficos de los terminos sobre universe^len(vs): un array de indices de
+    forma (n,)*len(vs) por termino, con el eje i para vs[i]. Cada subtermino
+    compartido se calcula una sola vez para todo el modelo.
+    Si algun termino queda indefinido levanta KeyError
+    """
+    n = len(model.universe)
+    k = len(vs)
+    axes = {v: i for i, v in enumerate(vs)}
+    values = {}
+    for t in _dag(terms):
+        if isinstance(t, _Variable):
+            try:
+                i = axes[t]
+            except KeyError:
+                raise ValueError("Free variable %s is not defined" % (t))
+            values[t] = np.arange(n).reshape((1,) * i + (n,) + (1,) * (k - i - 1))
+        else:
+            values[t] = _vcall_defined(model, t.sym.op, [values[a] for a in t.args])
+    return [np.broadcast_to(values[t], (n,) * k) for t in terms]
 
 
 # FORMULAS
 
-class _Formula(object):
+class _Formula(_Node):
     """
     Clase general de las formulas de primer orden
 
@@ -159,10 +315,12 @@ class _Formula(object):
     >>> (-(true() & true() & false())) | false()
     ⊤
 
+    >>> (R(x,y) & R(y,z)) is (R(y,z) & R(x,y))
+    True
+
     """
     
-    def __init__(self):
-        pass
+    __slots__ = ()
     
     def __and__(self, other):
         if isinstance(other, _AndFormula):
@@ -201,29 +359,107 @@ class _Formula(object):
         
         return _NegFormula(self)
     
-    def free_vars(self):
-        raise NotImplemented
-    
     def satisfy(self, model, vector):
         raise NotImplemented
     
-    def __eq__(self, other):
-        return hash(self) == hash(other)
+    def tensor(self, model, vs=None, arity=None):
+        """
+        Extension como tensor booleano de forma (n,)*len(vs) (o (n,)*arity
+        si arity es mayor, extendiendo por broadcasting). Cada subformula se
+        evalua de abajo hacia arriba como tensor sobre sus variables libres;
+        la variable numero a ocupa el eje -(a + 1), asi los tensores de
+        subformulas con menos variables se combinan por broadcasting. Los
+        terminos se evaluan en todo el universo, asi que levanta KeyError
+        si alguno queda indefinido en algun punto, aunque satisfy no
+        llegue a evaluarlo ahi
+        """
+        if vs is None:
+            vs = list(self.free_vars())
+        axes = {v: a for a, v in enumerate(vs)}
+        t = np.asarray(self._tensor(model, axes, [len(vs)]))
+        k = len(vs)
+        # los ejes de las variables cuantificadas quedaron de tamaño 1
+        t = t.reshape((1,) * (k - t.ndim) + t.shape[max(0, t.ndim - k):])
+        t = t.transpose(list(range(k))[::-1])
+        if arity and arity > k:
+            t = t.reshape(t.shape + (1,) * (arity - k))
+            k = arity
+        return np.broadcast_to(t, (len(model.universe),) * k)
+    
+    def vextension(self, model, arity=None):
+        """
+        Mismo resultado que extension, calculado con tensor. Si tensor se
+        encuentra con un termino indefinido (operaciones parciales) se
+        calcula con extension, que levanta KeyError solo si satisfy lo hace
+
+        >>> from fopy.first_order import Relation
+        >>> from fopy.first_order.examples import cyclic_successor
+        >>> N = cyclic_successor(3, {"P": Relation("P", 1, {(0,)})}).restrict([0, 1])
+        >>> x, = variables("x")
+        >>> s = OpSym("s", 1)
+        >>> eq(s(x), x).vextension(cyclic_successor(3))
+        set()
+        >>> (RelSym("P", 1)(x) & -eq(s(x), x)).vextension(N)
+        {(0,)}
+        >>> eq(s(s(x)), s(x)).vextension(N)
+        Traceback (most recent call last):
+        ...
+        KeyError: (1,)
+        """
+        try:
+            t = self.tensor(model, arity=arity)
+        except KeyError:
+            return self.extension(model, arity)
+        universe = model.universe
+        return {tuple(universe[i] for i in t) for t in np.argwhere(t)}
     
-    def __hash__(self):
-        raise NotImplemented
+    def _plan(self, model):
+        """
+        _JoinTable con la extension de la formula sobre sus variables libres,
+        o None si el planificador no sabe resolverla con joins
+        """
+        return None
     
     def extension(self, model, arity=None):
-        # TODO es un poco ineficiente al tener aridad mas grande que variables libres
-        result = set()
+        """
+        Extension de la formula, con las variables libres en el orden de
+        list(self.free_vars()). Las conjunciones (existenciales) de
+        relaciones se resuelven con joins; lo que no se puede planificar se
+        enumera
+
+        >>> from fopy.first_order import Relation
+        >>> from fopy.first_order.examples import cyclic_successor
+        >>> R = Relation("R", 2, {(0, 1), (1, 2), (2, 2), (3, 0), (3, 3)})
+        >>> M = cyclic_successor(4, {"R": R, "P": Relation("P", 1, {(2,), (3,)})})
+        >>> x, y, z = variables("x", "y", "z")
+        >>> Rs, P, s = RelSym("R", 2), RelSym("P", 1), OpSym("s", 1)
+        >>> def enumerated(phi):
+        ...     vs = list(phi.free_vars())
+        ...     return {t for t in product(M.universe, repeat=len(vs))
+        ...             if phi.satisfy(M, dict(zip(vs, t)))}
+        >>> queries = [exists(y, Rs(x, y) & Rs(y, z) & eq(s(x), y)) & P(z),
+        ...            Rs(x, x) & Rs(x, y),
+        ...            exists(x, Rs(x, y) & -P(y))]
+        >>> [q._plan(M) is not None and q.extension(M) == enumerated(q) for q in queries]
+        [True, True, True]
+        """
         vs = list(self.free_vars())
-        for t in product(model.universe,repeat=len(vs)):
-            if self.satisfy(model,{vs[i]:t[i] for i in range(len(t))}):
-                if arity and arity > len(vs):
-                    for tt in product(model.universe, repeat=arity - len(vs)):
-                        result.add(t+tt)
-                else:
-                    result.add(t)
+        table = self._plan(model)
+        if table is None:
+            # TODO es un poco ineficiente al tener aridad mas grande que variables libres
+            ts = (t for t in product(model.universe, repeat=len(vs))
+                  if self.satisfy(model, {vs[i]: t[i] for i in range(len(t))}))
+        else:
+            universe = model.universe
+            positions = [table.vs.index(v) for v in vs]
+            ts = (tuple(universe[row[i]] for i in positions) for row in table.rows)
+        result = set()
+        for t in ts:
+            if arity and arity > len(vs):
+                for tt in product(model.universe, repeat=arity - len(vs)):
+                    result.add(t+tt)
+            else:
+                result.add(t)
         
         return result
 
@@ -233,8 +469,14 @@ class _NegFormula(_Formula):
     Negacion de una formula
     """
     
-    def __init__(self, f):
-        self.f = f
+    __slots__ = ("f",)
+    
+    def __new__(cls, f):
+        node, new = cls._intern(f)
+        if new:
+            node.f = f
+            node._free_vars = f.free_vars()
+        return node
     
     def __repr__(self):
         return "¬ %s" % self.f
@@ -242,14 +484,15 @@ class _NegFormula(_Formula):
     def __neg__(self):
         return self.f
     
-    def __hash__(self):
-        return hash(("-", self.f))
-    
-    def free_vars(self):
-        return self.f.free_vars()
-    
     def satisfy(self, model, vector):
         return not self.f.satisfy(model, vector)
+    
+    def _compile(self, model, slots, nslots):
+        f = self.f._compile(model, slots, nslots)
+        return lambda env: not f(env)
+    
+    def _tensor(self, model, axes, naxes):
+        return ~self.f._tensor(model, axes, naxes)
 
 
 class _BinaryOpFormula(_Formula):
@@ -257,14 +500,15 @@ class _BinaryOpFormula(_Formula):
     Clase general de las formulas tipo f1 η ... η fn
     """
     
-    def __init__(self, subformulas):
-        self.subformulas = frozenset(subformulas)
+    __slots__ = ("subformulas",)
     
-    def free_vars(self):
-        result = set()
-        for f in self.subformulas:
-            result = result.union(f.free_vars())
-        return result
+    def __new__(cls, subformulas):
+        subformulas = frozenset(subformulas)
+        node, new = cls._intern(subformulas)
+        if new:
+            node.subformulas = subformulas
+            node._free_vars = frozenset().union(*[f.free_vars() for f in subformulas])
+        return node
 
 
 class _OrFormula(_BinaryOpFormula):
@@ -272,8 +516,7 @@ class _OrFormula(_BinaryOpFormula):
     Disjuncion entre formulas
     """
     
-    def __hash__(self):
-        return hash(("or", self.subformulas))
+    __slots__ = ()
     
     def __repr__(self):
         result = " ∨ ".join(str(f) for f in self.subformulas)
@@ -297,6 +540,22 @@ class _OrFormula(_BinaryOpFormula):
     def satisfy(self, model, vector):
         # el or y el and de python son lazy
         return any(f.satisfy(model, vector) for f in self.subformulas)
+    
+    def _compile(self, model, slots, nslots):
+        fs = tuple(f._compile(model, slots, nslots) for f in self.subformulas)
+        if len(fs) == 2:
+            f1, f2 = fs
+            return lambda env: f1(env) or f2(env)
+        
+        def f(env):
+            for g in fs:
+                if g(env):
+                    return True
+            return False
+        return f
+    
+    def _tensor(self, model, axes, naxes):
+        return reduce(np.logical_or, [f._tensor(model, axes, naxes) for f in self.subformulas])
 
 
 class _AndFormula(_BinaryOpFormula):
@@ -304,8 +563,7 @@ class _AndFormula(_BinaryOpFormula):
     Conjuncion entre formulas
     """
     
-    def __hash__(self):
-        return hash(("and", self.subformulas))
+    __slots__ = ()
     
     def __repr__(self):
         result = " ∧ ".join(str(f) for f in self.subformulas)
@@ -329,6 +587,48 @@ class _AndFormula(_BinaryOpFormula):
     def satisfy(self, model, vector):
         # el or y el and de python son lazy
         return all(f.satisfy(model, vector) for f in self.subformulas)
+    
+    def _compile(self, model, slots, nslots):
+        fs = tuple(f._compile(model, slots, nslots) for f in self.subformulas)
+        if len(fs) == 2:
+            f1, f2 = fs
+            return lambda env: f1(env) and f2(env)
+        
+        def f(env):
+            for g in fs:
+                if not g(env):
+                    return False
+            return True
+        return f
+    
+    def _tensor(self, model, axes, naxes):
+        return reduce(np.logical_and, [f._tensor(model, axes, naxes) for f in self.subformulas])
+    
+    def _plan(self, model):
+        tables = []
+        filters = []
+        for f in self.subformulas:
+            table = f._plan(model)
+            if table is None:
+                filters.append(f)
+            else:
+                tables.append(table)
+        if not tables:
+            return None
+        # de menor a mayor cardinalidad, prefiriendo las que comparten variables
+        tables.sort(key=lambda t: len(t.rows))
+        result = tables.pop(0)
+        while tables:
+            linked = [t for t in tables if set(t.vs) & set(result.vs)] or tables
+            table = linked[0]
+            tables.remove(table)
+            result = result.join(table)
+        for f in filters:
+            missing = [v for v in f.free_vars() if v not in result.vs]
+            if missing:
+                result = result.extend(missing, len(model.universe))
+            result = result.filter(f, model)
+        return result
 
 
 class RelSym(object):
@@ -351,6 +651,9 @@ class RelSym(object):
     
     def __hash__(self):
         return hash((self.rel, self.arity))
+    
+    def __eq__(self, other):
+        return isinstance(other, RelSym) and (self.rel, self.arity) == (other.rel, other.arity)
 
 
 class _RelFormula(_Formula):
@@ -358,9 +661,16 @@ class _RelFormula(_Formula):
     Formula de primer orden de la aplicacion de una relacion
     """
     
-    def __init__(self, sym, args):
-        self.sym = sym
-        self.args = args
+    __slots__ = ("sym", "args")
+    
+    def __new__(cls, sym, args):
+        args = tuple(args)
+        node, new = cls._intern(sym, args)
+        if new:
+            node.sym = sym
+            node.args = args
+            node._free_vars = frozenset().union(*[t.free_vars() for t in args])
+        return node
     
     def __repr__(self):
         result = repr(self.sym)
@@ -369,15 +679,37 @@ class _RelFormula(_Formula):
         result += ")"
         return result
     
-    def free_vars(self):
-        return set.union(*[f.free_vars() for f in self.args])
-    
     def satisfy(self, model, vector):
         args = [t.evaluate(model, vector) for t in self.args]
         return model.relations[self.sym.rel](*args)
     
-    def __hash__(self):
-        return hash((self.sym, self.args))
+    def _compile(self, model, slots, nslots):
+        rel = model.relations[self.sym.rel]
+        args = [t._compile(model, slots, nslots) for t in self.args]
+        if getattr(rel.storage, "table", None) is not None:
+            return _lookup(rel.storage.table, args)
+        icall = rel.icall
+        return lambda env: icall(*[a(env) for a in args])
+    
+    def _tensor(self, model, axes, naxes):
+        args = [t._tensor(model, axes, naxes) for t in self.args]
+        return np.asarray(model.relations[self.sym.rel].vcall(*args))
+    
+    def _plan(self, model):
+        if not all(isinstance(t, _Variable) for t in self.args):
+            return None
+        rows = map(tuple, model.relations[self.sym.rel].index_array().tolist())
+        vs = []
+        for v in self.args:
+            if v not in vs:
+                vs.append(v)
+        if len(vs) == len(self.args):
+            return _JoinTable(vs, set(rows))
+        # variables repetidas: me quedo con las tuplas que coinciden
+        positions = [self.args.index(v) for v in vs]
+        firsts = [self.args.index(v) for v in self.args]
+        return _JoinTable(vs, {tuple(t[i] for i in positions) for t in rows
+                               if all(t[i] == t[j] for i, j in enumerate(firsts))})
 
 
 class _EqFormula(_Formula):
@@ -385,25 +717,33 @@ class _EqFormula(_Formula):
     Formula de primer orden que es una igualdad entre terminos
     """
     
-    def __init__(self, t1, t2):
+    __slots__ = ("t1", "t2")
+    
+    def __new__(cls, t1, t2):
         if not (isinstance(t1, _Term) and isinstance(t2, _Term)):
             raise ValueError("Must be terms:%s %s" % (t1, t2))
         if t2 <= t1:
             t1, t2 = t2, t1
-        self.t1 = t1
-        self.t2 = t2
+        node, new = cls._intern(t1, t2)
+        if new:
+            node.t1 = t1
+            node.t2 = t2
+            node._free_vars = t1.free_vars() | t2.free_vars()
+        return node
     
     def __repr__(self):
         return "%s == %s" % (self.t1, self.t2)
     
-    def free_vars(self):
-        return set.union(self.t1.free_vars(), self.t2.free_vars())
-    
     def satisfy(self, model, vector):
         return self.t1.evaluate(model, vector) == self.t2.evaluate(model, vector)
     
-    def __hash__(self):
-        return hash((self.t1, self.t2))
+    def _compile(self, model, slots, nslots):
+        t1 = self.t1._compile(model, slots, nslots)
+        t2 = self.t2._compile(model, slots, nslots)
+        return lambda env: t1(env) == t2(env)
+    
+    def _tensor(self, model, axes, naxes):
+        return self.t1._tensor(model, axes, naxes) == self.t2._tensor(model, axes, naxes)
 
 
 class _QuantifierFormula(_Formula):
@@ -411,12 +751,36 @@ class _QuantifierFormula(_Formula):
     Clase general de una formula con cuantificador
     """
     
-    def __init__(self, var, f):
-        self.var = var
-        self.f = f
+    __slots__ = ("var", "f")
     
-    def free_vars(self):
-        return self.f.free_vars() - {self.var}
+    def __new__(cls, var, f):
+        node, new = cls._intern(var, f)
+        if new:
+            node.var = var
+            node.f = f
+            node._free_vars = f.free_vars() - {var}
+        return node
+    
+    def _compile_body(self, model, slots, nslots):
+        """
+        Compila la subformula con un slot propio para la variable ligada
+        """
+        slot = nslots[0]
+        nslots[0] += 1
+        slots = dict(slots)
+        slots[self.var] = slot
+        return slot, self.f._compile(model, slots, nslots)
+    
+    def _tensor_body(self, model, axes, naxes):
+        """
+        Tensor de la subformula con un eje propio para la variable ligada,
+        devuelve el eje (contado desde el final) y el tensor
+        """
+        axis = naxes[0]
+        naxes[0] += 1
+        axes = dict(axes)
+        axes[self.var] = axis
+        return -(axis + 1), self.f._tensor(model, axes, naxes)
 
 
 class _ForAllFormula(_QuantifierFormula):
@@ -424,18 +788,37 @@ class _ForAllFormula(_QuantifierFormula):
     Formula Universal
     """
     
+    __slots__ = ()
+    
     def __repr__(self):
         return "∀ %s %s" % (self.var, self.f)
     
     def satisfy(self, model, vector):
+        vector = vector.copy()
         for i in model.universe:
             vector[self.var] = i
             if not self.f.satisfy(model, vector):
                 return False
         return True
     
-    def __hash__(self):
-        return hash(("forall", self.var, self.f))
+    def _compile(self, model, slots, nslots):
+        slot, f = self._compile_body(model, slots, nslots)
+        elements = range(len(model.universe))
+        
+        def forall_f(env):
+            for i in elements:
+                env[slot] = i
+                if not f(env):
+                    return False
+            return True
+        return forall_f
+    
+    def _tensor(self, model, axes, naxes):
+        axis, t = self._tensor_body(model, axes, naxes)
+        if t.ndim < -axis:
+            # no depende de la variable ligada
+            return t
+        return t.all(axis=axis, keepdims=True)
 
 
 class _ExistsFormula(_QuantifierFormula):
@@ -443,6 +826,8 @@ class _ExistsFormula(_QuantifierFormula):
     Formula Existencial
     """
     
+    __slots__ = ()
+    
     def __repr__(self):
         return "∃ %s %s" % (self.var, self.f)
     
@@ -454,8 +839,30 @@ class _ExistsFormula(_QuantifierFormula):
                 return True
         return False
     
-    def __hash__(self):
-        return hash(("exists", self.var, self.f))
+    def _compile(self, model, slots, nslots):
+        slot, f = self._compile_body(model, slots, nslots)
+        elements = range(len(model.universe))
+        
+        def exists_f(env):
+            for i in elements:
+                env[slot] = i
+                if f(env):
+                    return True
+            return False
+        return exists_f
+    
+    def _tensor(self, model, axes, naxes):
+        axis, t = self._tensor_body(model, axes, naxes)
+        if t.ndim < -axis:
+            # no depende de la variable ligada
+            return t
+        return t.any(axis=axis, keepdims=True)
+    
+    def _plan(self, model):
+        table = self.f._plan(model)
+        if table is None or self.var not in table.vs:
+            return table
+        return table.project([v for v in table.vs if v != self.var])
 
 
 class _TrueFormula(_Formula):
@@ -463,22 +870,30 @@ class _TrueFormula(_Formula):
     Formula de primer orden constantemente verdadera
     """
     
+    __slots__ = ()
+    
+    def __new__(cls):
+        node, new = cls._intern()
+        if new:
+            node._free_vars = frozenset()
+        return node
+    
     def __repr__(self):
         return "⊤"
     
-    def free_vars(self):
-        return set()
-    
     def satisfy(self, model, vector):
         return True
     
+    def _compile(self, model, slots, nslots):
+        return lambda env: True
+    
+    def _tensor(self, model, axes, naxes):
+        return np.ones((), dtype=np.bool_)
+    
     def extension(self, model, arity=None):
         if arity is None:
             raise ValueError("Extension of a non declared formula")
         return set(product(model.universe, repeat=arity))
-    
-    def __hash__(self):
-        return hash(repr(self))
 
 
 class _FalseFormula(_Formula):
@@ -486,22 +901,30 @@ class _FalseFormula(_Formula):
     Formula de primer orden constantemente falsa
     """
     
+    __slots__ = ()
+    
+    def __new__(cls):
+        node, new = cls._intern()
+        if new:
+            node._free_vars = frozenset()
+        return node
+    
     def __repr__(self):
         return "⊥"
     
-    def free_vars(self):
-        return set()
-    
     def satisfy(self, model, vector):
         return False
     
+    def _compile(self, model, slots, nslots):
+        return lambda env: False
+    
+    def _tensor(self, model, axes, naxes):
+        return np.zeros((), dtype=np.bool_)
+    
     def extension(self, model, arity=None):
         if arity is None:
             raise ValueError("Extension of a non declared formula")
         return set()
-    
-    def __hash__(self):
-        return hash(repr(self))
 
 
 # Shortcuts
@@ -547,6 +970,111 @@ def false():
     return _FalseFormula()
 
 
+class _JoinTable(object):
+    """
+    Relacion intermedia del planificador de extension: un set de tuplas de
+    indices del universo, una coordenada por cada variable de vs
+    """
+    
+    def __init__(self, vs, rows):
+        self.vs = tuple(vs)
+        self.rows = rows
+    
+    def join(self, other):
+        """
+        Hash join por las variables en comun, indexando la tabla mas chica
+        """
+        if len(other.rows) > len(self.rows):
+            return other.join(self)
+        common = [v for v in self.vs if v in other.vs]
+        extra = [i for i, v in enumerate(other.vs) if v not in self.vs]
+        skey = [self.vs.index(v) for v in common]
+        okey = [other.vs.index(v) for v in common]
+        index = defaultdict(list)
+        for r in other.rows:
+            index[tuple(r[i] for i in okey)].append(tuple(r[i] for i in extra))
+        rows = {r + e for r in self.rows for e in index.get(tuple(r[i] for i in skey), ())}
+        return _JoinTable(self.vs + tuple(other.vs[i] for i in extra), rows)
+    
+    def project(self, vs):
+        positions = [self.vs.index(v) for v in vs]
+        return _JoinTable(vs, {tuple(r[i] for i in positions) for r in self.rows})
+    
+    def extend(self, vs, n):
+        """
+        Agrega las variables vs enumerando el universo (de tamaño n)
+        """
+        ts = list(product(range(n), repeat=len(vs)))
+        return _JoinTable(self.vs + tuple(vs), {r + t for r in self.rows for t in ts})
+    
+    def filter(self, formula, model):
+        """
+        Se queda con las filas que satisfacen formula (compilada)
+        """
+        slots = {v: i for i, v in enumerate(self.vs)}
+        nslots = [len(self.vs)]
+        f = formula._compile(model, slots, nslots)
+        extra = [0] * (nslots[0] - len(self.vs))
+        return _JoinTable(self.vs, {r for r in self.rows if f(list(r) + extra)})
+
+
+def _lookup(table, args):
+    """
+    Closure que indexa table (operacion o relacion densa) con los valores
+    de las closures args, usando listas anidadas de Python
+    """
+    t = table.tolist()
+    if len(args) == 0:
+        return lambda env: t
+    elif len(args) == 1:
+        a, = args
+        return lambda env: t[a(env)]
+    elif len(args) == 2:
+        a, b = args
+        return lambda env: t[a(env)][b(env)]
+    elif len(args) == 3:
+        a, b, c = args
+        return lambda env: t[a(env)][b(env)][c(env)]
+    item = table.item
+    return lambda env: item(tuple(a(env) for a in args))
+
+
+def compile_formula(formula, model, vs=None, indices=False):
+    """
+    Compila formula para model en una funcion de Python que recibe los
+    valores de las variables libres en el orden de vs (por defecto ordenadas
+    por nombre) y devuelve lo mismo que formula.satisfy. Las variables van
+    en slots de una lista, las operaciones y relaciones quedan ligadas a sus
+    tablas y los cuantificadores cortan apenas deciden.
+    Con indices=True la funcion recibe indices del universo en vez de elementos.
+
+    >>> from fopy.first_order import Relation
+    >>> from fopy.first_order.examples import cyclic_successor
+    >>> M = cyclic_successor(3, {"R": Relation("R", 2, {(0, 1), (1, 2)})})
+    >>> x, y = variables("x", "y")
+    >>> f = compile_formula(exists(y, RelSym("R", 2)(x, y) & eq(OpSym("s", 1)(x), y)), M)
+    >>> [f(a) for a in M.universe]
+    [True, True, False]
+    """
+    if vs is None:
+        vs = sorted(formula.free_vars(), key=repr)
+    slots = {v: i for i, v in enumerate(vs)}
+    nslots = [len(vs)]
+    f = formula._compile(model, slots, nslots)
+    size = nslots[0]
+    index = model.index
+    
+    if indices:
+        def compiled(*values):
+            env = list(values) + [0] * (size - len(values))
+            return f(env)
+    else:
+        def compiled(*values):
+            env = [index[a] for a in values] + [0] * (size - len(values))
+            return f(env)
+    return compiled
+
+
 # Formulas generators
 
 def grafico(term, vs, model):
@@ -556,30 +1084,129 @@ def grafico(term, vs, model):
     return tuple(sorted(result.items()))
 
 
+class TermGraphEngine(object):
+    """
+    Generador de terminos por sus graficos. El grafico de un termino es un
+    vector de indices sobre universe^len(vs) (en el orden de product) y el
+    de f(t1, ..., tk) se calcula con los de t1, ..., tk indexando una sola
+    vez la tabla de f. Dos terminos con el mismo grafico son el mismo, asi
+    que se descartan comparando los bytes del vector.
+    En cada ronda solo se arman los f(t1, ..., tk) con algun ti de la ronda
+    anterior. max_bytes acota la memoria de los graficos guardados
+    (MemoryError si se pasa). Con operaciones parciales se descartan los
+    terminos que quedan indefinidos en algun punto.
+
+    >>> from fopy.first_order import Model, Operation
+    >>> m = Operation("m", 2)
+    >>> for a in range(2):
+    ...     for b in range(2):
+    ...         m.add((a, b, min(a, b)))
+    >>> x, y = variables("x", "y")
+    >>> TermGraphEngine([OpSym("m", 2)], [x, y], Model([0, 1], {}, {"m": m})).run()
+    [x, y, m(x, y)]
+    >>> from fopy.first_order.examples import cyclic_successor
+    >>> TermGraphEngine([OpSym("s", 1)], [x], cyclic_successor(4).view([0, 1, 2])).run()
+    [x]
+    """
+    
+    def __init__(self, functions, vs, model, max_bytes=None):
+        self.functions = functions
+        self.vs = vs
+        self.model = model
+        self.max_bytes = max_bytes
+        self.dtype = np.min_scalar_type(max(len(model.universe) - 1, 0))
+        self.terms = []
+        self.graphs = []
+        self.index = {}
+        self.seen = set()
+        self.nbytes = 0
+    
+    def graph(self, term):
+        """
+        Grafico de un termino ya generado
+        """
+        return self.graphs[self.index[term]]
+    
+    def _add(self, term, graph):
+        key = graph.tobytes()
+        if key in self.seen:
+            return False
+        if self.max_bytes is not None and self.nbytes + len(key) > self.max_bytes:
+            raise MemoryError("Term graphs exceed %s bytes" % self.max_bytes)
+        self.seen.add(key)
+        self.nbytes += len(key)
+        self.index[term] = len(self.terms)
+        self.terms.append(term)
+        self.graphs.append(graph)
+        return True
+    
+    def rounds(self):
+        """
+        Itera por rondas, devolviendo la lista de terminos nuevos de cada una
+        """
+        first = len(self.terms)
+        constants = [f() for f in self.functions if f.arity == 0]
+        for t in self.vs + constants:
+            try:
+                g, = term_tensors([t], self.model, self.vs)
+            except KeyError:
+                # constante indefinida
+                continue
+            self._add(t, g.ravel().astype(self.dtype))
+        frontier = first
+        while frontier < len(self.terms):
+            end = len(self.terms)
+            yield self.terms[frontier:end]
+            for f in self.functions:
+                if f.arity:
+                    self._combine(f, frontier, end)
+            frontier = end
+    
+    def _combine(self, f, frontier, end):
+        """
+        Agrega los f(t1, ..., tk) nuevos con algun argumento en
+        terms[frontier:end]: si el primero en la
+        frontera es el p, los anteriores son viejos y los siguientes
+        cualquiera. La ultima coordenada se calcula vectorizada
+        """
+        op = self.model.operations[f.op]
+        ranges = []
+        for p in range(f.arity):
+            ranges.append([range(0, frontier)] * p + [range(frontier, end)] +
+                          [range(0, end)] * (f.arity - p - 1))
+        n = len(self.graphs[0]) if self.graphs else 0
+        step = max(1, CHUNK_CELLS // max(n, 1))
+        block = np.array(self.graphs[:end])
+        for rs in ranges:
+            last = rs[-1]
+            for prefix in product(*rs[:-1]):
+                args = [self.graphs[i] for i in prefix]
+                for i in range(last.start, last.stop, step):
+                    j = min(i + step, last.stop)
+                    results = np.asarray(op.vcall(*(args + [block[i:j]])))
+                    # el -1 no entra en dtype: se descartan antes de achicar
+                    defined = (results >= 0).all(axis=1)
+                    for k in np.flatnonzero(defined).tolist():
+                        g = results[k].astype(self.dtype)
+                        if g.tobytes() not in self.seen:
+                            ts = [self.terms[a] for a in prefix] + [self.terms[i + k]]
+                            self._add(f(*ts), g)
+    
+    def run(self):
+        """
+        Genera todos los terminos (hasta que no aparecen graficos nuevos)
+        """
+        for _ in self.rounds():
+            pass
+        return self.terms
+
+
 def generate_terms(funtions, vs, model):
     """
     Devuelve todos los terminos (en realidad solo para infimo y supremo)
     usando las funciones y las variables con un anidaminento de rec
     """
-    result = []
-    graficos = set()
-    
-    for v in vs:
-        g = grafico(v, vs, model)
-        if not g in graficos:
-            result.append(v)
-            graficos.add(g)
-    nuevos = [1]
-    while nuevos:
-        nuevos = []
-        for f in funtions:
-            for ts in product(result, repeat=f.arity):
-                g = grafico(f(*ts), vs, model)
-                if not g in graficos:
-                    nuevos.append(f(*ts))
-                    graficos.add(g)
-            result += nuevos
-    return result
+    return TermGraphEngine(funtions, vs, model).run()
 
 
 def atomics(relations, terms, equality=True):
@@ -2,44 +2,114 @@
 #!/usr/bin/env python
 
 from fopy.misc.misc import indent
+from fopy.first_order._relops import CHUNK_CELLS, _with_undefined
+
+import numpy as np
 # TODO decoradores para morfismos procedurales
 # TODO embeddings? automorfismos? Mejorar que solo se imprima el tipo distinto pero que sean iguales.
 
 class Homomorphism(object):
-    def __init__(self, d, source, target, subtype):
-        self.values = d
+    """
+    Morfismo guardado como array de indices: array[i] es el indice en
+    target.universe de la imagen de source.universe[i] (-1 si no esta
+    definida). d puede ser ese array o un diccionario de elementos
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> h = Homomorphism({0: 0, 1: 2, 2: 0, 3: 2}, M, M)
+    >>> h(3), h(np.array([1, 2])).tolist()
+    (2, [2, 0])
+    >>> h.kernel()
+    Congruence([|0, 2|, |1, 3|])
+    >>> h.composition(h).array.tolist(), h.image_model().universe
+    ([0, 0, 0, 0], [0, 2])
+    >>> Homomorphism({0: 0, 1: 2}, M, M).kernel()
+    Traceback (most recent call last):
+    ...
+    ValueError: Kernel of a partial map
+    """
+
+    def __init__(self, d, source, target, subtype=None):
+        if isinstance(d, np.ndarray):
+            self.array = np.asarray(d, dtype=np.intp)
+        else:
+            index = target.index
+            self.array = np.array([index[d[x]] if x in d else -1 for x in source.universe],
+                                  dtype=np.intp)
         self.source = source
         self.target = target
         self.subtype = subtype
 
+    @property
+    def values(self):
+        return {self.source.universe[i]: self.target.universe[j]
+                for i, j in enumerate(self.array.tolist()) if j >= 0}
+
     def __call__(self, x):
+        """
+        Imagen de un elemento (None si no esta definida) o, si x es un
+        array de indices de source, el array de indices de las imagenes
+        """
+        if isinstance(x, np.ndarray):
+            return self.take(x)
         try:
-            return self.values[x]
+            result = self._image(self.source.index[x])
         except KeyError:
             return
+        if result < 0:
+            return
+        return self.target.universe[result]
+    
+    def _image(self, i):
+        return int(self.array[i])
+    
+    def take(self, indices):
+        """
+        Array de indices de las imagenes de un array de indices de source
+        (el -1 queda en -1)
+        """
+        return _with_undefined(self.array)[indices]
 
     def vcall(self, xvector):
         return tuple(self(x) for x in xvector)
 
-    def __repr__(self):
-        result = "Homomorphism(\n"
-        for a, b in self.values.items():
-            result += "  %s->%s\n" % (a, b)
-        result += "from:\n"
-        result += indent(repr(self.source))
-        result += "to:\n"
-        result += indent(repr(self.target))
-        result += ")"
+    def composition(self, other):
+        """
+        self o other (primero other), indexando un array con el otro
+        """
+        return Homomorphism(self.take(other.array), other.source, self.target, self.subtype)
+
+    def kernel(self):
+        """
+        Congruencia de source que junta los elementos con la misma imagen,
+        solo para morfismos totales
+        """
+        from fopy.first_order.congruences import Congruence
+        if (self.array < 0).any():
+            raise ValueError("Kernel of a partial map")
+        result = Congruence((), self.source)
+        result.from_ids(self.array)
         return result
 
+    def image_model(self):
+        """
+        Imagen como vista de target (sin copiar tablas)
+        """
+        image = np.unique(self.array[self.array >= 0])
+        return self.target.view([self.target.universe[i] for i in image.tolist()])
 
-class Isomorphism(Homomorphism):
+    def __eq__(self, other):
+        return (isinstance(other, Homomorphism) and self.source is other.source and
+                self.target is other.target and np.array_equal(self.array, other.array))
 
-    def inverse(self):
-        return Isomorphism({v: k for k, v in self.values.items()}, self.target, self.source, self.subtype)
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.array.tobytes())
 
     def __repr__(self):
-        result = "Isomorphism(\n"
+        result = "%s(\n" % type(self).__name__
         for a, b in self.values.items():
             result += "  %s->%s\n" % (a, b)
         result += "from:\n"
@@ -50,19 +120,51 @@ class Isomorphism(Homomorphism):
         return result
 
 
-class Automorphism(Isomorphism):
-    def __init__(self, d, model, subtype):
-        super(Automorphism).__init__(d,model,model,subtype)
+class LazyHomomorphism(Homomorphism):
+    """
+    Morfismo dado por una funcion f que lleva arrays de indices de source
+    en arrays de indices de target (sin -1). array se arma recien cuando
+    se pide, asi que aplicarlo a unos pocos elementos no recorre source
+    """
+    
+    def __init__(self, f, source, target, subtype=None):
+        self.f = f
+        self.source = source
+        self.target = target
+        self.subtype = subtype
+        self._array = None
+    
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = self.take(np.arange(len(self.source)))
+        return self._array
+    
+    def _image(self, i):
+        return int(self.f(np.intp(i)))
+    
+    def take(self, indices):
+        indices = np.asarray(indices)
+        defined = indices >= 0
+        return np.where(defined, self.f(np.where(defined, indices, 0)), -1).astype(np.intp)
 
-    def __call__(self, x):
-        try:
-            return self.values[x]
-        except KeyError:
-            return
-        return self.values[x]
 
-    def vcall(self, xvector):
-        return tuple(self(x) for x in xvector)
+class Isomorphism(Homomorphism):
+
+    def inverse(self):
+        array = np.full(len(self.target.universe), -1, dtype=np.intp)
+        defined = self.array >= 0
+        array[self.array[defined]] = np.flatnonzero(defined)
+        return Isomorphism(array, self.target, self.source, self.subtype)
+
+
+class Automorphism(Isomorphism):
+    def __init__(self, d, model, subtype=None):
+        super(Automorphism, self).__init__(d, model, model, subtype)
+
+    def inverse(self):
+        result = super(Automorphism, self).inverse()
+        return Automorphism(result.array, self.source, self.subtype)
 
     def __repr__(self):
         result = "Automorphism(\n"
@@ -73,3 +175,108 @@ class Automorphism(Isomorphism):
         result += ")"
         return result
 
+
+def _map_array(h, source, target):
+    """
+    Array de indices de un morfismo, un array o un diccionario
+    """
+    if isinstance(h, Homomorphism):
+        result = h.array
+    elif isinstance(h, np.ndarray):
+        result = np.asarray(h, dtype=np.intp)
+    else:
+        result = Homomorphism(h, source, target).array
+    if (result < 0).any():
+        raise ValueError("Map is not total")
+    return result
+
+
+def homomorphism_witness(h, source, target):
+    """
+    Devuelve None si h (Homomorphism, array de indices o diccionario) es
+    un homomorfismo de source en target, o un testigo (sym, t): una tupla
+    de source donde h no preserva la operacion o relacion sym.
+    Para cada operacion compara target_op[h[args]] con h[source_op[args]]
+    sobre toda la tabla y las tuplas de cada relacion se pasan por h y se
+    preguntan en la relacion de target
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> homomorphism_witness({0: 0, 1: 2, 2: 0, 3: 2}, M, M) is None
+    True
+    >>> homomorphism_witness({0: 0, 1: 1, 2: 0, 3: 1}, M, M)
+    ('+', (1, 1))
+    """
+    h = _map_array(h, source, target)
+    h_ext = _with_undefined(h)
+    n = len(source.universe)
+    for sym, op in source.operations.items():
+        values = np.asarray(op.vcall(*np.ix_(*[np.arange(n)] * op.arity)))
+        images = np.asarray(target.operations[sym].vcall(*np.ix_(*[h] * op.arity)))
+        differ = np.argwhere((values >= 0) & (images != h_ext[values]))
+        if len(differ):
+            return sym, tuple(source.universe[i] for i in differ[0].tolist())
+    for sym, rel in source.relations.items():
+        if not rel.arity:
+            if len(rel) and not target.relations[sym]():
+                return sym, ()
+            continue
+        idx = rel.index_array()
+        inside = np.asarray(target.relations[sym].vcall(*h[idx].T))
+        bad = np.flatnonzero(~inside)
+        if len(bad):
+            return sym, tuple(source.universe[i] for i in idx[bad[0]].tolist())
+    return None
+
+
+def is_homomorphism(h, source, target):
+    return homomorphism_witness(h, source, target) is None
+
+
+def are_homomorphisms(maps, source, target):
+    """
+    Version en tanda de is_homomorphism: maps es un array (m, n) con un
+    mapa de indices por fila; devuelve un array booleano de largo m
+
+    >>> from fopy.first_order.examples import cyclic_group
+    >>> M = cyclic_group(4)
+    >>> are_homomorphisms(np.array([[0, 2, 0, 2], [0, 1, 0, 1], [0, 3, 2, 1]]), M, M)
+    array([ True, False,  True])
+    """
+    maps = np.asarray(maps, dtype=np.intp)
+    if (maps < 0).any():
+        raise ValueError("Maps are not total")
+    m, n = maps.shape
+    result = np.ones(m, dtype=bool)
+    for sym, op in source.operations.items():
+        values = np.asarray(op.vcall(*np.ix_(*[np.arange(n)] * op.arity)))
+        defined = values >= 0
+        values = np.where(defined, values, 0)
+        target_op = target.operations[sym]
+        step = max(1, CHUNK_CELLS // max(1, values.size))
+        for i in range(0, m, step):
+            chunk = maps[i:i + step]
+            args = [chunk.reshape((len(chunk),) + (1,) * p + (n,) + (1,) * (op.arity - p - 1))
+                    for p in range(op.arity)]
+            if args:
+                images = np.asarray(target_op.vcall(*args))
+            else:
+                images = np.broadcast_to(target_op.vcall(), (len(chunk),))
+            expected = chunk[:, values]
+            ok = (images == expected) | ~defined
+            result[i:i + step] &= ok.reshape(len(chunk), -1).all(axis=1)
+    for sym, rel in source.relations.items():
+        target_rel = target.relations[sym]
+        if not rel.arity:
+            if len(rel) and not target_rel():
+                result[:] = False
+            continue
+        idx = rel.index_array()
+        if not len(idx):
+            continue
+        step = max(1, CHUNK_CELLS // len(idx))
+        for i in range(0, m, step):
+            mapped = maps[i:i + step][:, idx]
+            inside = np.asarray(target_rel.vcall(*np.moveaxis(mapped, -1, 0)))
+            result[i:i + step] &= inside.all(axis=1)
+    return result
@@ -3,6 +3,7 @@
 import sys
 
 from fopy.first_order import Model, Relation, Operation
+from fopy.first_order._relops import density, choose_storage
 
 
 class ParserError(Exception):
@@ -62,6 +63,7 @@ def parser(path=None, verbose=True):
     rel_missing_tuples = 0
     op_missing_tuples = 0
     universe = None
+    interned = index = None
     for linenumber, line in enumerate(f):
         assert (current_op is None or current_rel is None)
         try:
@@ -70,6 +72,10 @@ def parser(path=None, verbose=True):
                 if universe is None:
                     # tiene que ser el universo!
                     universe = parse_universe(line)
+                    # mismo internado que va a hacer Model, asi las relaciones
+                    # se cargan directo en su representacion final
+                    interned = sorted(universe)
+                    index = {e: i for i, e in enumerate(interned)}
                 elif current_rel is None and current_op is None:
                     if line.count(" ") == 1:
                         # empieza una operacion
@@ -82,10 +88,14 @@ def parser(path=None, verbose=True):
                     elif line.count(" ") == 2:
                         # empieza una relacion
                         current_rel, rel_missing_tuples = parse_defrel(line)
+                        storage = choose_storage(len(universe), current_rel.arity, rel_missing_tuples)
+                        current_rel.intern(interned, index, storage)
                         if verbose:
                             try:
-                                print("%s density: %f" % (
-                                current_rel.sym, float(rel_missing_tuples) / (len(universe) ** current_rel.arity)))
+                                print("%s density: %f (%s)" % (
+                                current_rel.sym,
+                                density(rel_missing_tuples, len(universe), current_rel.arity),
+                                storage))
                             except:
                                 print("WARNING: no pudo calcular la densidad")
                 else: